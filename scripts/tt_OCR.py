@@ -1,75 +1,266 @@
 import cv2
+import numpy as np
 import pytesseract
 import os
+import csv
+import time
+import tempfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tt_manifest import StageManifest, atomic_write
 
 # Configure pytesseract path if necessary (only required if Tesseract is not in the system path)
 # pytesseract.pytesseract.tesseract_cmd = r'path_to_tesseract_executable'
 
-def extract_text_from_frame(frame):
+def extract_text_from_frames(gray_frames):
     """
-    Extract text from a given video frame using Tesseract OCR.
+    Extract text from a batch of grayscale frames with a single Tesseract call.
+    The frames are written to a temporary image list, which Tesseract reads as one
+    multi-page document, so the engine and language data are loaded once per batch
+    instead of once per frame. Returns one string per frame.
     """
-    # Convert the frame to grayscale (improves OCR accuracy)
-    gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if not gray_frames:
+        return []
 
-    # Use pytesseract to extract text from the frame
-    extracted_text = pytesseract.image_to_string(gray_frame)
+    with tempfile.TemporaryDirectory(prefix="tt_ocr_") as tmp_dir:
+        image_paths = []
+        for i, gray_frame in enumerate(gray_frames):
+            image_path = os.path.join(tmp_dir, f"frame_{i:05d}.png")
+            cv2.imwrite(image_path, gray_frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            image_paths.append(image_path)
 
-    return extracted_text.strip()
+        list_file = os.path.join(tmp_dir, "frames.txt")
+        with open(list_file, 'w') as f:
+            f.write("\n".join(image_paths) + "\n")
 
-def extract_frames_and_text(video_path, output_text_file, frame_interval=30):
+        # Tesseract separates the text of consecutive pages with a form feed
+        extracted_text = pytesseract.image_to_string(list_file)
+
+    pages = extracted_text.split("\f")
+    pages += [""] * (len(gray_frames) - len(pages))
+    return [page.strip() for page in pages[:len(gray_frames)]]
+
+def sample_frames(video_capture, frame_interval):
+    """
+    Yield (frame_number, grayscale_frame) for every nth frame of an open video.
+    Skipped frames are only grabbed, never retrieved, so they are not converted
+    into images.
+    """
+    frame_count = 0
+    while True:
+        if frame_count % frame_interval == 0:
+            success, frame = video_capture.read()
+            if not success:
+                break
+            yield frame_count, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        elif not video_capture.grab():
+            break
+        frame_count += 1
+
+def frame_thumbnail(gray_frame, size=(64, 36)):
+    """Shrink a grayscale frame to size (width, height) by area averaging, as float32."""
+    return cv2.resize(gray_frame, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def frame_difference(thumbnail, other):
+    """
+    Largest change of any thumbnail cell between two frames, in gray levels, after
+    removing the mean change so that global brightness shifts do not count. Each cell
+    averages a patch of the frame, so noise mostly cancels out, while a caption change
+    moves the cells it covers by several levels.
+    """
+    difference = thumbnail - other
+    return float(np.max(np.abs(difference - difference.mean())))
+
+def find_text_region(gray_frame, padding=8):
+    """
+    Locate the part of a grayscale frame that looks like it holds caption text.
+    Strong local gradients are binarised and smeared horizontally so the letters
+    of a line merge into one blob; blobs shaped like text lines are kept and the
+    padded bounding box around all of them is returned as (x, y, w, h), or None
+    when the frame shows no text-like region.
+    """
+    frame_height, frame_width = gray_frame.shape[:2]
+    gradient = cv2.morphologyEx(gray_frame, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    line_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(9, frame_width // 40), 1))
+    connected = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, line_kernel)
+    contours, _ = cv2.findContours(connected, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if h < 8 or h > frame_height // 4 or w < 1.5 * h:
+            continue
+        # Text lines are dense in edges; large smooth shapes are not
+        if cv2.countNonZero(binary[y:y + h, x:x + w]) < 0.2 * w * h:
+            continue
+        boxes.append((x, y, x + w, y + h))
+
+    if not boxes:
+        return None
+    boxes = np.array(boxes)
+    x0 = max(0, boxes[:, 0].min() - padding)
+    y0 = max(0, boxes[:, 1].min() - padding)
+    x1 = min(frame_width, boxes[:, 2].max() + padding)
+    y1 = min(frame_height, boxes[:, 3].max() + padding)
+    return int(x0), int(y0), int(x1 - x0), int(y1 - y0)
+
+def remove_consecutive_duplicates(texts):
+    """
+    Drop OCR lines that repeat the line right before them, so a caption that stays
+    on screen across several sampled frames is kept once.
+    """
+    lines = []
+    for text in texts:
+        for line in text.splitlines():
+            line = line.strip()
+            if line and (not lines or line != lines[-1]):
+                lines.append(line)
+    return lines
+
+def get_frame_interval(video_capture, frame_interval=30, fps=None):
+    """
+    Return the frame interval to sample at. When fps is given, the interval is
+    derived from the video's own frame rate so that about fps frames are sampled
+    per second of video; otherwise frame_interval is used as-is.
+    """
+    if fps:
+        video_fps = video_capture.get(cv2.CAP_PROP_FPS)
+        if video_fps and video_fps > 0:
+            return max(1, round(video_fps / fps))
+    return max(1, frame_interval)
+
+def extract_frames_and_text(video_path, output_text_file, frame_interval=30, fps=None, batch_size=16, dedup_threshold=None, crop_text=False):
     """
     Extract frames from a video at regular intervals and apply OCR to extract text.
-    Save the extracted text to a file.
+    When dedup_threshold is set, a sampled frame is only OCRed when it differs from the
+    last OCRed frame by more than dedup_threshold gray levels (see frame_difference);
+    by default every sampled frame is OCRed.
+    With crop_text, only the detected caption region of each frame is OCRed and
+    frames without one are skipped.
+    Frames are sent to Tesseract in batches of batch_size.
+    Save the extracted text to a file and return per-video statistics.
     """
+    start = time.perf_counter()
+
     # Open the video file
     video_capture = cv2.VideoCapture(video_path)
-    
-    frame_count = 0
-    extracted_texts = []
-
-    while True:
-        # Read the next frame from the video
-        success, frame = video_capture.read()
+    frame_interval = get_frame_interval(video_capture, frame_interval, fps)
 
-        if not success:
-            break  # Stop the loop if there are no more frames
+    extracted_texts = []
+    batch_numbers, batch_frames = [], []
+    last_thumbnail = None
+    sampled_count = ocr_count = 0
 
-        # Process every nth frame (based on frame_interval)
-        if frame_count % frame_interval == 0:
-            # Extract text from the current frame
-            text = extract_text_from_frame(frame)
+    def flush_batch():
+        for number, text in zip(batch_numbers, extract_text_from_frames(batch_frames)):
             if text:
                 extracted_texts.append(text)
-                print(f"Extracted text from frame {frame_count}: {text}")
+                print(f"Extracted text from frame {number}: {text}")
+        batch_numbers.clear()
+        batch_frames.clear()
 
-        frame_count += 1
+    for frame_number, gray_frame in sample_frames(video_capture, frame_interval):
+        sampled_count += 1
+        if crop_text:
+            region = find_text_region(gray_frame)
+            if region is None:
+                continue  # No caption on screen
+            x, y, w, h = region
+            gray_frame = gray_frame[y:y + h, x:x + w]
+        if dedup_threshold is not None:
+            # With crop_text only the caption is compared, so changes elsewhere are ignored
+            thumbnail = frame_thumbnail(gray_frame)
+            if last_thumbnail is not None and frame_difference(thumbnail, last_thumbnail) <= dedup_threshold:
+                continue  # Same on-screen content as the last OCRed frame
+            last_thumbnail = thumbnail
+        ocr_count += 1
+        batch_numbers.append(frame_number)
+        batch_frames.append(gray_frame)
+        if len(batch_frames) >= batch_size:
+            flush_batch()
+    flush_batch()
 
     # Release the video capture object
     video_capture.release()
 
-    # Save extracted text to the output file
-    with open(output_text_file, 'w') as f:
-        for text in extracted_texts:
-            f.write(text + "\n")
+    # Save extracted text to the output file, without consecutive repeated lines
+    with atomic_write(output_text_file) as f:
+        for line in remove_consecutive_duplicates(extracted_texts):
+            f.write(line + "\n")
 
+    elapsed = time.perf_counter() - start
+    print(f"OCRed {ocr_count} of {sampled_count} sampled frames in {elapsed:.2f}s.")
     print(f"Extracted text saved to {output_text_file}")
+    return {
+        "video": os.path.basename(video_path),
+        "sampled_frames": sampled_count,
+        "ocr_frames": ocr_count,
+        "seconds": round(elapsed, 3),
+    }
 
-def process_videos_in_folder(input_folder, output_folder, frame_interval=30):
+def limit_tesseract_threads():
+    """
+    Keep each Tesseract call single-threaded inside worker processes, so N workers
+    use N cores instead of oversubscribing them.
+    """
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def write_summary(summary_file, video_stats):
+    """Write per-video OCR statistics to a CSV summary file."""
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=["video", "sampled_frames", "ocr_frames", "seconds"])
+        writer.writeheader()
+        writer.writerows(sorted(video_stats, key=lambda stats: stats["video"]))
+    print(f"Per-video OCR summary saved to {summary_file}")
+
+def process_videos_in_folder(input_folder, output_folder, frame_interval=30, fps=None, batch_size=16, dedup_threshold=None,
+                             crop_text=False, workers=1, summary_file=None, force=False):
     """
     Process all video files in a folder, extract text from them, and save the results.
+    With workers > 1 the videos are OCRed in parallel in a process pool. Videos whose
+    output is up to date with the stage manifest are skipped unless force is set.
     """
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
+    manifest = StageManifest(output_folder, "ocr", {
+        "frame_interval": frame_interval, "fps": fps, "dedup_threshold": dedup_threshold, "crop_text": crop_text
+    })
+    tasks = []
+    video_count = 0
     for file_name in os.listdir(input_folder):
         if file_name.endswith(".mp4"):
+            video_count += 1
             video_path = os.path.join(input_folder, file_name)
             output_text_file = os.path.join(output_folder, f"{os.path.splitext(file_name)[0]}_text.txt")
+            if not force and manifest.is_up_to_date(file_name, [video_path], [output_text_file]):
+                continue
+            tasks.append((video_path, output_text_file, frame_interval, fps, batch_size, dedup_threshold, crop_text))
+    print(f"{video_count - len(tasks)} of {video_count} videos already processed, {len(tasks)} to process.")
+
+    video_stats = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=limit_tesseract_threads) as executor:
+            futures = {executor.submit(extract_frames_and_text, *task): task for task in tasks}
+            for future in as_completed(futures):
+                video_path, output_text_file = futures[future][:2]
+                try:
+                    video_stats.append(future.result())
+                except Exception as e:
+                    print(f"Error processing {video_path}: {e}")
+                    continue
+                manifest.record(os.path.basename(video_path), [video_path], [output_text_file])
+    else:
+        for task in tasks:
+            print(f"Processing video: {task[0]}")
+            video_stats.append(extract_frames_and_text(*task))
+            manifest.record(os.path.basename(task[0]), [task[0]], [task[1]])
+    manifest.compact()
 
-            print(f"Processing video: {video_path}")
-            extract_frames_and_text(video_path, output_text_file, frame_interval)
+    if summary_file is None:
+        summary_file = os.path.join(output_folder, "ocr_summary.csv")
+    write_summary(summary_file, video_stats)
 
 def main():
     # Set up argparse for command-line arguments
@@ -77,11 +268,19 @@ def main():
     parser.add_argument("input_folder", type=str, help="Path to the folder containing video files.")
     parser.add_argument("output_folder", type=str, help="Path to the folder where extracted text will be saved.")
     parser.add_argument("--frame_interval", type=int, default=30, help="Interval of frames to process (default is every 30th frame).")
+    parser.add_argument("--fps", type=float, default=None, help="Frames to sample per second of video; overrides --frame_interval when set.")
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of frames sent to Tesseract per call (default: 16).")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Skip OCR of frames that differ from the last OCRed frame by at most this many gray levels; 4 separates rendered caption changes from noise (default: off, every sampled frame is OCRed).")
+    parser.add_argument("--crop_text", action="store_true", help="Only OCR the detected caption region of each frame.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of videos to OCR in parallel (default: 1).")
+    parser.add_argument("--force", action="store_true", help="Reprocess every video, even those whose output is up to date.")
+    parser.add_argument("--summary_file", type=str, default=None, help="CSV file for per-video timings (default: ocr_summary.csv in the output folder).")
 
     args = parser.parse_args()
 
     # Process all video files in the input folder
-    process_videos_in_folder(args.input_folder, args.output_folder, args.frame_interval)
+    process_videos_in_folder(args.input_folder, args.output_folder, args.frame_interval, args.fps, args.batch_size,
+                             args.dedup_threshold, args.crop_text, args.workers, args.summary_file, args.force)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,579 @@
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import warnings
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+
+def time_call(func, *args, **kwargs):
+    """Run func once and return its result and the elapsed seconds."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def synthetic_descriptors(n_rows, unique_fraction=0.3, seed=42, vocabulary_size=None):
+    """
+    Build a Series of comma-separated descriptor strings that looks like the NER
+    output: words drawn from a Zipf-like vocabulary (perfume terms, filler and stop
+    words), with about unique_fraction of the rows being distinct strings. A larger
+    vocabulary_size pads the vocabulary with rare made-up terms.
+    """
+    rng = np.random.default_rng(seed)
+    base_words = [
+        "vanilla", "amber", "woody", "musky", "citrus", "bergamot", "rose", "jasmine", "oud", "leather",
+        "powdery", "fresh", "sweet", "smoky", "spicy", "creamy", "gourmand", "fruity", "floral", "green",
+        "notes", "smells", "like", "really", "long", "lasting", "projection", "the", "and", "of",
+        "pistachios", "cherries", "almonds", "berries", "candles", "flowers", "woods", "spices", "musks", "resins",
+    ]
+    vocabulary = base_words + [f"{word}{suffix}" for word in base_words for suffix in ("ish", "y", "ed", "s")]
+    if vocabulary_size and vocabulary_size > len(vocabulary):
+        vocabulary += [f"term{i}" for i in range(vocabulary_size - len(vocabulary))]
+    weights = 1.0 / np.arange(1, len(vocabulary) + 1)
+    weights /= weights.sum()
+
+    n_unique = max(1, int(n_rows * unique_fraction))
+    lengths = rng.integers(3, 15, size=n_unique)
+    words = rng.choice(len(vocabulary), size=lengths.sum(), p=weights)
+    texts, offset = [], 0
+    for length in lengths:
+        texts.append(", ".join(vocabulary[i] for i in words[offset:offset + length]))
+        offset += length
+    return pd.Series(np.array(texts, dtype=object)[rng.integers(0, n_unique, size=n_rows)])
+
+def benchmark_preprocess(args):
+    """
+    Compare descriptor preprocessing rows/sec of the original per-row implementation
+    (a new WordNetLemmatizer and a regex compile lookup per row, no reuse) with the
+    cached, deduplicated preprocess_series path.
+    """
+    import tt_data_preprocess
+    from nltk.stem import WordNetLemmatizer
+    stop_words = tt_data_preprocess.get_stop_words()
+
+    def preprocess_original(text):
+        text = text.lower()
+        text = re.sub(r'[^a-zA-Z\s]', '', text)
+        words = text.split()
+        lemmatizer = WordNetLemmatizer()
+        filtered_words = [
+            lemmatizer.lemmatize(word)
+            for word in words
+            if word not in stop_words and len(word) > 1
+        ]
+        return ' '.join(filtered_words)
+
+    descriptors = synthetic_descriptors(args.rows, args.unique_fraction)
+    print(f"Synthetic descriptors: {len(descriptors)} rows, {descriptors.nunique()} distinct strings.")
+
+    # Warm WordNet up so neither path pays its one-time load
+    tt_data_preprocess.get_lemmatizer().lemmatize("warmup")
+
+    baseline_rows = descriptors.iloc[:min(args.baseline_rows, len(descriptors))]
+    baseline, baseline_time = time_call(baseline_rows.apply, preprocess_original)
+    print(f"original apply:          {len(baseline_rows) / baseline_time:>12,.0f} rows/s "
+          f"({len(baseline_rows)} rows in {baseline_time:.2f}s)")
+
+    for workers in sorted(set([1, args.workers])):
+        tt_data_preprocess.normalize_word.cache_clear()
+        result, elapsed = time_call(tt_data_preprocess.preprocess_series, descriptors, workers)
+        print(f"preprocess_series (x{workers}): {len(descriptors) / elapsed:>12,.0f} rows/s "
+              f"({len(descriptors)} rows in {elapsed:.2f}s)")
+
+    if not result.iloc[:len(baseline)].equals(baseline):
+        print("WARNING: outputs of the original and the optimized path differ.")
+
+def benchmark_startup(args):
+    """
+    Time fresh interpreters that import tt_data_preprocess, with and without loading
+    its NLTK resources, and report the median of several runs.
+    """
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    snippets = {
+        "import only": "import tt_data_preprocess",
+        "import + NLTK resources": (
+            "import tt_data_preprocess as t; t.get_stop_words(); t.get_lemmatizer().lemmatize('warmup')"
+        ),
+    }
+    env = dict(os.environ)
+    if args.offline:
+        env["NLTK_OFFLINE"] = "1"
+    for label, snippet in snippets.items():
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", snippet], cwd=scripts_dir, env=env, check=True)
+            timings.append(time.perf_counter() - start)
+        print(f"{label:<24} median {np.median(timings):.3f}s, min {min(timings):.3f}s over {args.runs} runs")
+
+def benchmark_interchange(args):
+    """
+    Compare the CSV and the columnar (Parquet, Feather) hand-off between preprocessing,
+    TF-IDF and the network stage: write time and file size of the preprocessed table,
+    the time tt_tfidf takes to load, clean and group it, and the time to read the
+    resulting perfume mapping back.
+    """
+    from tt_io import read_table, write_table
+    from tt_tfidf import load_perfume_descriptors
+
+    rng = np.random.default_rng(0)
+    n_perfumes = max(1, args.rows // args.rows_per_perfume)
+    perfume_ids = rng.integers(0, n_perfumes, size=args.rows)
+    descriptors = synthetic_descriptors(args.rows, args.unique_fraction)
+    descriptors[rng.random(args.rows) < 0.02] = np.nan
+    df = pd.DataFrame({
+        "brand": [f"Brand {i % max(1, n_perfumes // 20)}" for i in perfume_ids],
+        "perfume_name": [f"Perfume {i}" for i in perfume_ids],
+        "descriptors": descriptors,
+    })
+    print(f"Synthetic table: {len(df)} rows, {n_perfumes} perfumes.")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for extension in ("csv", "parquet", "feather"):
+            table_path = os.path.join(tmp_dir, f"descriptors.{extension}")
+            mapping_path = os.path.join(tmp_dir, f"mapping.{extension}")
+            _, write_time = time_call(write_table, df, table_path)
+            with contextlib.redirect_stdout(None):
+                grouped, load_time = time_call(load_perfume_descriptors, table_path)
+            write_table(grouped[["brand", "perfume_name"]].reset_index(), mapping_path)
+            _, mapping_time = time_call(read_table, mapping_path)
+            results[extension] = grouped
+            print(f"{extension:<8} write {write_time:6.2f}s, {os.path.getsize(table_path) / 2**20:8.1f} MB, "
+                  f"tfidf load {load_time:6.2f}s, mapping read {mapping_time:6.3f}s")
+
+    baseline = results["csv"]
+    for extension, grouped in results.items():
+        if grouped["descriptors"].tolist() != baseline["descriptors"].tolist():
+            print(f"WARNING: {extension} and csv produce different combined descriptors.")
+
+def top_neighbors(vectors, queries, k):
+    """Indices of the k most cosine-similar rows for each query row, excluding itself."""
+    from sklearn.preprocessing import normalize
+    vectors = normalize(vectors)
+    similarities = vectors[queries] @ vectors.T
+    similarities = similarities.toarray() if hasattr(similarities, "toarray") else np.asarray(similarities)
+    similarities[np.arange(len(queries)), queries] = -np.inf
+    return np.argpartition(-similarities, k, axis=1)[:, :k]
+
+def neighbor_recall(reference, candidate):
+    """Mean fraction of the reference neighbors that the candidate neighbors recover."""
+    return np.mean([len(set(r) & set(c)) / len(r) for r, c in zip(reference, candidate)])
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+def benchmark_tfidf(args):
+    """
+    Compare the exact (TfidfVectorizer) and the hashing TF-IDF modes: wall time and peak
+    RSS of a fresh process running each, size of the saved matrix and vectorizer state,
+    and how well the hashing mode preserves top-k cosine neighbors, both on the TF-IDF
+    rows and on NMF topic vectors fitted from each matrix.
+    """
+    from sklearn.decomposition import NMF
+    from sklearn.exceptions import ConvergenceWarning
+    from tt_io import load_sparse_matrix
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    rng = np.random.default_rng(0)
+    n_perfumes = max(args.k + 1, args.rows // args.rows_per_perfume)
+    perfume_ids = rng.integers(0, n_perfumes, size=args.rows)
+    df = pd.DataFrame({
+        "brand": [f"Brand {i % max(1, n_perfumes // 20)}" for i in perfume_ids],
+        "perfume_name": [f"Perfume {i}" for i in perfume_ids],
+        "descriptors": synthetic_descriptors(args.rows, args.unique_fraction, vocabulary_size=args.vocabulary_size),
+    })
+
+    runs = {
+        "exact": "tt_tfidf.compute_tfidf(input_file, output, mapping)",
+        "hashing": f"tt_tfidf.compute_hashed_tfidf(input_file, output, mapping, {args.n_features}, {args.chunk_size})",
+    }
+    matrices = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, "descriptors.csv")
+        df.to_csv(input_file, index=False)
+        print(f"Synthetic table: {len(df)} rows, {n_perfumes} perfumes, vocabulary of up to {args.vocabulary_size} terms.")
+        baseline = subprocess.run(
+            [sys.executable, "-c", "import resource, tt_tfidf; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"],
+            cwd=scripts_dir, capture_output=True, text=True, check=True,
+        )
+        print(f"{'imports':<8} peak RSS {int(baseline.stdout) / 1024:8.1f} MB")
+        for mode, call in runs.items():
+            output = os.path.join(tmp_dir, mode)
+            snippet = (
+                "import sys, time, resource, contextlib, tt_tfidf\n"
+                f"input_file, output, mapping = {input_file!r}, {output!r}, {output + '_mapping.csv'!r}\n"
+                "start = time.perf_counter()\n"
+                "with contextlib.redirect_stdout(None):\n"
+                f"    {call}\n"
+                "print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+            )
+            result = subprocess.run([sys.executable, "-c", snippet], cwd=scripts_dir, capture_output=True, text=True, check=True)
+            elapsed, max_rss = result.stdout.split()
+            matrices[mode] = load_sparse_matrix(output, mmap=False)
+            print(f"{mode:<8} time {float(elapsed):6.2f}s, peak RSS {int(max_rss) / 1024:8.1f} MB, "
+                  f"saved {folder_size(output) / 2**20:7.1f} MB, {matrices[mode].shape[1]} columns")
+
+    # Neighbor agreement on a sample of perfumes
+    queries = rng.choice(n_perfumes, size=min(args.queries, n_perfumes), replace=False)
+    exact, hashed = matrices["exact"], matrices["hashing"]
+    recall = neighbor_recall(top_neighbors(exact, queries, args.k), top_neighbors(hashed, queries, args.k))
+    print(f"TF-IDF top-{args.k} neighbor recall of hashing vs exact: {recall:.3f}")
+
+    # Empty hash buckets carry nothing; dropping them keeps the NMF fit the same size.
+    # NMF neighbors also move between two fits of the same matrix, so a second exact
+    # fit with another seed gives the noise floor to read the hashing recall against.
+    hashed = hashed[:, np.flatnonzero(hashed.getnnz(axis=0))]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        exact_W, exact_reseeded_W, hashed_W = (
+            NMF(n_components=args.n_topics, random_state=seed, max_iter=300).fit_transform(matrix)
+            for matrix, seed in ((exact, 42), (exact, 0), (hashed, 42))
+        )
+    reference = top_neighbors(exact_W, queries, args.k)
+    print(f"NMF ({args.n_topics} topics) top-{args.k} neighbor recall of hashing vs exact: "
+          f"{neighbor_recall(reference, top_neighbors(hashed_W, queries, args.k)):.3f} "
+          f"(exact refit with another seed: {neighbor_recall(reference, top_neighbors(exact_reseeded_W, queries, args.k)):.3f})")
+
+def benchmark_similarity(args):
+    """
+    Compare the original top-N neighbor search (dense cosine_similarity, then a full
+    argsort per row) with the blocked top_k_neighbors engine on random topic vectors.
+    """
+    from sklearn.metrics.pairwise import cosine_similarity
+    from tt_similarity import top_k_neighbors
+
+    rng = np.random.default_rng(0)
+    W = rng.random((args.perfumes, args.n_topics)) ** 4  # Skewed like NMF topic weights
+    print(f"Topic vectors: {args.perfumes} perfumes x {args.n_topics} topics, top {args.k}.")
+
+    def original(W):
+        similarity_matrix = cosine_similarity(W)
+        return np.array([row.argsort()[-(args.k + 1):-1] for row in similarity_matrix])
+
+    if args.perfumes <= args.baseline_limit:
+        baseline, elapsed = time_call(original, W)
+        print(f"cosine_similarity + argsort: {elapsed:7.2f}s, {args.perfumes ** 2 * 8 / 2**20:9.1f} MB similarity matrix")
+    else:
+        baseline = None
+        print(f"cosine_similarity + argsort: skipped above {args.baseline_limit} perfumes")
+    for workers in sorted(set([1, args.workers])):
+        (indices, _, _), elapsed = time_call(top_k_neighbors, W, args.k, args.block_size, workers)
+        print(f"blocked top-k (x{workers}):       {elapsed:7.2f}s, "
+              f"{args.block_size * args.perfumes * 8 * workers / 2**20:9.1f} MB of blocks in flight")
+    if baseline is not None:
+        print(f"Neighbor agreement with the original: {neighbor_recall(baseline, indices):.4f}")
+
+def synthetic_topic_vectors(n_perfumes, n_topics, seed=0):
+    """
+    Nonnegative topic vectors shaped like NMF output: each perfume mixes a few dominant
+    topics with small weights elsewhere.
+    """
+    rng = np.random.default_rng(seed)
+    W = rng.random((n_perfumes, n_topics)) ** 4 * 0.1
+    dominant = rng.integers(0, n_topics, size=(n_perfumes, 3))
+    np.put_along_axis(W, dominant, rng.random((n_perfumes, 3)), axis=1)
+    return W
+
+def benchmark_ann(args):
+    """
+    Recall vs latency of the IVF index over topic vectors for a range of n_probe values,
+    against exact cosine search (a full scan per query).
+    """
+    from tt_similarity import IVFIndex, normalize_rows
+
+    W = synthetic_topic_vectors(args.perfumes, args.n_topics)
+    rng = np.random.default_rng(1)
+    queries = rng.choice(args.perfumes, size=min(args.queries, args.perfumes), replace=False)
+    print(f"Topic vectors: {args.perfumes} perfumes x {args.n_topics} topics, {len(queries)} queries, top {args.k}.")
+
+    index, elapsed = time_call(IVFIndex.build, W, None, args.n_lists)
+    print(f"Index built in {elapsed:.2f}s with {len(index.centroids)} lists.")
+
+    # Exact search: one full scan per query
+    W_normalized = normalize_rows(W)
+    exact, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        scores = W_normalized @ W_normalized[q]
+        scores[q] = -np.inf
+        best = np.argpartition(-scores, args.k)[:args.k]
+        exact.append(best[np.argsort(-scores[best])])
+        latencies.append(time.perf_counter() - start)
+    print(f"{'exact':<12} recall 1.000, p50 {np.percentile(latencies, 50) * 1000:7.3f} ms, "
+          f"p99 {np.percentile(latencies, 99) * 1000:7.3f} ms")
+
+    for n_probe in args.n_probe:
+        found, latencies = [], []
+        for q in queries:
+            start = time.perf_counter()
+            ids, _ = index.query_ids(q, args.k, n_probe)
+            latencies.append(time.perf_counter() - start)
+            found.append(ids[0])
+        print(f"n_probe {n_probe:<4} recall {neighbor_recall(exact, found):.3f}, "
+              f"p50 {np.percentile(latencies, 50) * 1000:7.3f} ms, p99 {np.percentile(latencies, 99) * 1000:7.3f} ms")
+
+def benchmark_sparse(args):
+    """
+    Top-k similarity search on topic vectors kept as float64, as float32, and as float32
+    with weights below epsilon dropped (sparse products): time, peak traced memory, size
+    of the normalized W and top-k agreement with dense cosine_similarity(W).
+    """
+    import tracemalloc
+    from sklearn.metrics.pairwise import cosine_similarity
+    from tt_similarity import normalize_rows, compact_rows, top_k_neighbors
+
+    W = synthetic_topic_vectors(args.perfumes, args.n_topics)
+    print(f"Topic vectors: {args.perfumes} perfumes x {args.n_topics} topics, top {args.k}.")
+
+    def measure(func, *func_args):
+        # Timed without tracing, which slows allocations down; peak memory from a second, traced run
+        result, elapsed = time_call(func, *func_args)
+        tracemalloc.start()
+        func(*func_args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, elapsed, peak / 2**20
+
+    def dense_top_k(W):
+        similarities = cosine_similarity(W)
+        np.fill_diagonal(similarities, -np.inf)
+        best = np.argpartition(-similarities, args.k, axis=1)[:, :args.k]
+        return best
+
+    if args.perfumes <= args.baseline_limit:
+        reference, elapsed, peak = measure(dense_top_k, W)
+        print(f"{'cosine_similarity(W)':<24} {elapsed:7.2f}s, peak {peak:9.1f} MB, W {W.nbytes / 2**20:7.1f} MB")
+    else:
+        (reference, _, _), elapsed, peak = measure(top_k_neighbors, W, args.k, args.block_size)
+        print(f"cosine_similarity(W): skipped above {args.baseline_limit} perfumes; "
+              f"blocked float64 search is the reference ({elapsed:.2f}s, peak {peak:.1f} MB)")
+
+    runs = [("float64", np.float64, 0.0), ("float32", np.float32, 0.0)]
+    runs += [(f"float32, eps {epsilon:g}", np.float32, epsilon) for epsilon in args.epsilon]
+    for name, dtype, epsilon in runs:
+        W_run = W.astype(dtype)
+        if epsilon > 0:
+            W_compact = compact_rows(normalize_rows(W_run), epsilon)
+            if isinstance(W_compact, np.ndarray):
+                stored = W_compact.nbytes
+                density = f", density {np.count_nonzero(W_compact) / W_compact.size:.3f} (too dense, kept dense)"
+            else:
+                stored = W_compact.data.nbytes + W_compact.indices.nbytes + W_compact.indptr.nbytes
+                density = f", density {W_compact.nnz / np.prod(W_compact.shape):.3f} (sparse)"
+        else:
+            stored, density = W_run.nbytes, ""
+        (indices, _, _), elapsed, peak = measure(top_k_neighbors, W_run, args.k, args.block_size, 1, None, epsilon)
+        print(f"{name:<24} {elapsed:7.2f}s, peak {peak:9.1f} MB, W {stored / 2**20:7.1f} MB{density}, "
+              f"top-{args.k} agreement {neighbor_recall(reference, indices):.4f}")
+
+def benchmark_dedup(args):
+    """
+    How well frame_difference separates OCR frames that repeat a caption from frames
+    where the caption changed. Captions are rendered on flat, gradient and blurred
+    textured backgrounds; repeats get fresh pixel noise and a brightness shift. For
+    each threshold, reports the share of repeats skipped and of changes missed.
+    """
+    import cv2
+    from tt_OCR import frame_thumbnail, frame_difference
+
+    rng = np.random.default_rng(0)
+    height, width = 1280, 720  # Portrait, like TikTok videos
+    captions = ["HELLO WORLD", "VANILLA AMBER", "TOP NOTES: BERGAMOT", "SMELLS LIKE|A RAINY DAY", "10/10 WOULD BUY",
+                "HELLO WORLD!", None]
+
+    def background(kind):
+        if kind == "flat":
+            return np.full((height, width), 90, np.uint8)
+        if kind == "gradient":
+            return np.tile(np.linspace(40, 200, width), (height, 1)).astype(np.uint8)
+        texture = cv2.resize((rng.random((height // 8, width // 8)) * 255).astype(np.uint8), (width, height))
+        return cv2.GaussianBlur(texture, (0, 0), 6)
+
+    def render(base, caption):
+        frame = base.copy()
+        for i, line in enumerate((caption or "").split("|")):
+            cv2.putText(frame, line, (40, 900 + i * 70), cv2.FONT_HERSHEY_SIMPLEX, args.font_scale, 255,
+                        max(1, round(2.5 * args.font_scale)))
+        noisy = frame + rng.normal(0, args.noise, frame.shape) + rng.uniform(-args.brightness, args.brightness)
+        return frame_thumbnail(np.clip(noisy, 0, 255).astype(np.uint8))
+
+    repeats, changes = [], []
+    for kind in ["flat", "gradient", "texture", "texture", "texture"]:
+        base = background(kind)
+        for caption in captions:
+            for _ in range(3):
+                repeats.append(frame_difference(render(base, caption), render(base, caption)))
+        for i, caption in enumerate(captions):
+            for other in captions[i + 1:]:
+                changes.append(frame_difference(render(base, caption), render(base, other)))
+    repeats, changes = np.array(repeats), np.array(changes)
+    print(f"Font scale {args.font_scale}, noise sigma {args.noise}, brightness shift up to {args.brightness}.")
+    print(f"Repeated caption: {len(repeats)} pairs, difference max {repeats.max():.2f}")
+    print(f"Changed caption:  {len(changes)} pairs, difference min {changes.min():.2f}, "
+          f"10th percentile {np.percentile(changes, 10):.2f}")
+    for threshold in args.thresholds:
+        print(f"threshold {threshold:5.1f}: skips {np.mean(repeats <= threshold):6.1%} of repeats, "
+              f"misses {np.mean(changes <= threshold):6.1%} of caption changes")
+
+def benchmark_service(args):
+    """
+    Latency and throughput of the similarity service under concurrent, Zipf-distributed
+    perfume queries (a few popular perfumes, a long tail). Targets a running service
+    with --url, or else starts one in-process on synthetic topic vectors.
+    """
+    import json
+    import threading
+    import urllib.error
+    import urllib.request
+    from urllib.parse import urlencode
+    from concurrent.futures import ThreadPoolExecutor
+
+    server = None
+    if args.url:
+        url = args.url.rstrip('/')
+        with urllib.request.urlopen(f"{url}/stats") as response:
+            n_perfumes = json.load(response)['perfumes']
+        mapping = None
+    else:
+        from tt_similarity_service import SimilarityServer, SimilarityService, make_handler
+        n_perfumes = args.perfumes
+        mapping = pd.DataFrame({
+            'index': np.arange(n_perfumes),
+            'brand': [f"brand{i % 500}" for i in range(n_perfumes)],
+            'perfume_name': [f"perfume{i}" for i in range(n_perfumes)],
+        })
+        service = SimilarityService(mapping, synthetic_topic_vectors(n_perfumes, args.n_topics),
+                                    cache_size=args.cache_size, batch_window=args.batch_window_ms / 1000)
+        server = SimilarityServer(("127.0.0.1", 0), make_handler(service))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+    print(f"Service at {url}: {n_perfumes} perfumes, {args.requests} requests, {args.concurrency} concurrent clients.")
+
+    if mapping is None:
+        if not args.mapping_file:
+            raise SystemExit("--mapping_file is needed with --url, to pick the perfumes to query.")
+        from tt_io import read_table
+        mapping = read_table(args.mapping_file)
+    # Zipf popularity over a random order of the perfumes
+    rng = np.random.default_rng(0)
+    popularity = rng.permutation(len(mapping))
+    picks = popularity[np.minimum(rng.zipf(args.zipf_a, size=args.requests) - 1, len(mapping) - 1)]
+    brands = mapping['brand'].astype(str).to_numpy()
+    names = mapping['perfume_name'].astype(str).to_numpy()
+
+    def send(row):
+        query = urlencode({'brand': brands[row], 'perfume_name': names[row], 'k': args.k})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{url}/similar?{query}") as response:
+                response.read()
+            ok = True
+        except urllib.error.URLError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, picks))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([latency for latency, _ in results])
+    errors = sum(not ok for _, ok in results)
+    print(f"Throughput {len(results) / elapsed:8.1f} requests/s, errors {errors}")
+    print(f"Latency p50 {np.percentile(latencies, 50) * 1000:7.2f} ms, p99 {np.percentile(latencies, 99) * 1000:7.2f} ms, "
+          f"mean {latencies.mean() * 1000:7.2f} ms")
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        print(f"Service stats: {json.load(response)}")
+    if server is not None:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the fragrance network pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    preprocess_parser = subparsers.add_parser("preprocess", help="Descriptor preprocessing rows/sec, before and after.")
+    preprocess_parser.add_argument("--rows", type=int, default=1000000, help="Number of synthetic rows (default: 1,000,000).")
+    preprocess_parser.add_argument("--baseline_rows", type=int, default=100000, help="Rows timed with the original implementation (default: 100,000).")
+    preprocess_parser.add_argument("--unique_fraction", type=float, default=0.3, help="Fraction of distinct descriptor strings (default: 0.3).")
+    preprocess_parser.add_argument("--workers", type=int, default=4, help="Processes for the multiprocess run (default: 4).")
+    preprocess_parser.set_defaults(func=benchmark_preprocess)
+
+    startup_parser = subparsers.add_parser("startup", help="Startup time of the preprocessing module.")
+    startup_parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to time (default: 5).")
+    startup_parser.add_argument("--offline", action="store_true", help="Run with NLTK_OFFLINE=1.")
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    interchange_parser = subparsers.add_parser("interchange", help="CSV vs Parquet/Feather hand-off between stages.")
+    interchange_parser.add_argument("--rows", type=int, default=1000000, help="Number of synthetic rows (default: 1,000,000).")
+    interchange_parser.add_argument("--rows_per_perfume", type=int, default=20, help="Average rows per perfume (default: 20).")
+    interchange_parser.add_argument("--unique_fraction", type=float, default=0.3, help="Fraction of distinct descriptor strings (default: 0.3).")
+    interchange_parser.set_defaults(func=benchmark_interchange)
+
+    tfidf_parser = subparsers.add_parser("tfidf", help="Exact vs hashing TF-IDF: time, memory and neighbor quality.")
+    tfidf_parser.add_argument("--rows", type=int, default=500000, help="Number of synthetic rows (default: 500,000).")
+    tfidf_parser.add_argument("--rows_per_perfume", type=int, default=20, help="Average rows per perfume (default: 20).")
+    tfidf_parser.add_argument("--unique_fraction", type=float, default=0.3, help="Fraction of distinct descriptor strings (default: 0.3).")
+    tfidf_parser.add_argument("--vocabulary_size", type=int, default=200000, help="Size of the synthetic vocabulary (default: 200,000).")
+    tfidf_parser.add_argument("--n_features", type=int, default=2**18, help="Hash buckets for the hashing mode (default: 262,144).")
+    tfidf_parser.add_argument("--chunk_size", type=int, default=100000, help="Rows per chunk for the hashing mode (default: 100,000).")
+    tfidf_parser.add_argument("--n_topics", type=int, default=20, help="NMF topics for the downstream comparison (default: 20).")
+    tfidf_parser.add_argument("--k", type=int, default=10, help="Neighbors compared per perfume (default: 10).")
+    tfidf_parser.add_argument("--queries", type=int, default=1000, help="Perfumes sampled for the neighbor comparison (default: 1,000).")
+    tfidf_parser.set_defaults(func=benchmark_tfidf)
+
+    similarity_parser = subparsers.add_parser("similarity", help="Dense vs blocked top-k similarity search.")
+    similarity_parser.add_argument("--perfumes", type=int, default=20000, help="Number of synthetic perfumes (default: 20,000).")
+    similarity_parser.add_argument("--n_topics", type=int, default=10, help="Topics per perfume (default: 10).")
+    similarity_parser.add_argument("--k", type=int, default=5, help="Neighbors per perfume (default: 5).")
+    similarity_parser.add_argument("--block_size", type=int, default=512, help="Rows per block (default: 512).")
+    similarity_parser.add_argument("--workers", type=int, default=4, help="Threads for the parallel run (default: 4).")
+    similarity_parser.add_argument("--baseline_limit", type=int, default=30000, help="Largest size the dense baseline is run at (default: 30,000).")
+    similarity_parser.set_defaults(func=benchmark_similarity)
+
+    ann_parser = subparsers.add_parser("ann", help="Recall vs latency of the IVF index against exact search.")
+    ann_parser.add_argument("--perfumes", type=int, default=200000, help="Number of synthetic perfumes (default: 200,000).")
+    ann_parser.add_argument("--n_topics", type=int, default=20, help="Topics per perfume (default: 20).")
+    ann_parser.add_argument("--n_lists", type=int, default=None, help="Index lists (default: about 4 * sqrt(perfumes)).")
+    ann_parser.add_argument("--n_probe", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64], help="n_probe values to try (default: 1 2 4 8 16 32 64).")
+    ann_parser.add_argument("--k", type=int, default=10, help="Neighbors per query (default: 10).")
+    ann_parser.add_argument("--queries", type=int, default=500, help="Number of queries (default: 500).")
+    ann_parser.set_defaults(func=benchmark_ann)
+
+    dedup_parser = subparsers.add_parser("dedup", help="Repeated vs changed captions under the OCR frame comparison.")
+    dedup_parser.add_argument("--font_scale", type=float, default=0.8, help="OpenCV font scale of the captions (default: 0.8, small).")
+    dedup_parser.add_argument("--noise", type=float, default=5.0, help="Pixel noise sigma, in gray levels (default: 5).")
+    dedup_parser.add_argument("--brightness", type=float, default=6.0, help="Largest global brightness shift between frames (default: 6).")
+    dedup_parser.add_argument("--thresholds", type=float, nargs='+', default=[1, 2, 4, 6, 8, 12], help="Thresholds to evaluate (default: 1 2 4 6 8 12).")
+    dedup_parser.set_defaults(func=benchmark_dedup)
+
+    sparse_parser = subparsers.add_parser("sparse", help="float32 and sparsified topic vectors vs dense float64 similarity.")
+    sparse_parser.add_argument("--perfumes", type=int, default=20000, help="Number of synthetic perfumes (default: 20,000).")
+    sparse_parser.add_argument("--n_topics", type=int, default=50, help="Topics per perfume (default: 50).")
+    sparse_parser.add_argument("--k", type=int, default=10, help="Neighbors per perfume (default: 10).")
+    sparse_parser.add_argument("--block_size", type=int, default=512, help="Rows per block (default: 512).")
+    sparse_parser.add_argument("--epsilon", type=float, nargs='+', default=[0.01, 0.05, 0.1], help="Sparsification thresholds to try (default: 0.01 0.05 0.1).")
+    sparse_parser.add_argument("--baseline_limit", type=int, default=30000, help="Largest size the cosine_similarity baseline is run at (default: 30,000).")
+    sparse_parser.set_defaults(func=benchmark_sparse)
+
+    service_parser = subparsers.add_parser("service", help="Latency and throughput of the similarity service.")
+    service_parser.add_argument("--url", type=str, default=None, help="Base URL of a running service (default: start one on synthetic data).")
+    service_parser.add_argument("--mapping_file", type=str, default=None, help="Perfume mapping of the running service, to draw queries from (with --url).")
+    service_parser.add_argument("--perfumes", type=int, default=50000, help="Number of synthetic perfumes (default: 50,000).")
+    service_parser.add_argument("--n_topics", type=int, default=20, help="Topics per perfume (default: 20).")
+    service_parser.add_argument("--requests", type=int, default=5000, help="Number of requests (default: 5,000).")
+    service_parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients (default: 16).")
+    service_parser.add_argument("--zipf_a", type=float, default=1.2, help="Zipf exponent of perfume popularity (default: 1.2).")
+    service_parser.add_argument("--k", type=int, default=10, help="Neighbors per query (default: 10).")
+    service_parser.add_argument("--cache_size", type=int, default=10000, help="Cache size of the in-process service (default: 10,000).")
+    service_parser.add_argument("--batch_window_ms", type=float, default=2.0, help="Batch window of the in-process service, in ms (default: 2).")
+    service_parser.set_defaults(func=benchmark_service)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import openai
 import os
 import json
+import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import threading
 import argparse
 from dotenv import load_dotenv
-from openai import OpenAIError
+from openai import OpenAIError, AsyncOpenAI, APIConnectionError, APIStatusError
+from tt_manifest import StageManifest, atomic_write
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -50,74 +57,348 @@ json_schema = {
     "additionalProperties": False
 }
 
-def extract_entities_and_phrases(text):
+def build_request(text):
     """
-    Use OpenAI's ChatGPT API to extract entities (perfume brands, product names) 
-    and descriptive phrases from text, formatted according to the provided schema.
+    Build the keyword arguments of the chat completion request for the given text.
     """
     prompt = f"Extract perfume brand names, perfume product names, and key descriptive phrases from the following text. Format the descriptors as a list of comma-separated values:\n\n{text}"
-    
-    try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You're an expert in perfume descriptions."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "perfume_data",
-                    "schema": json_schema,
-                    "strict": True
-                }
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "You're an expert in perfume descriptions."},
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "perfume_data",
+                "schema": json_schema,
+                "strict": True
             }
+        }
+    }
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of API responses, keyed by a hash of the full request
+    (model, prompt with its input text, system message and JSON schema), so any
+    change to the prompt or schema misses the cache while unchanged inputs hit it.
+    When the stored responses exceed max_bytes, the least recently used ones are
+    evicted.
+    """
+    def __init__(self, cache_file, max_bytes=1024 ** 3):
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
         )
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(request):
+        """Content hash of a request built by build_request."""
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for key, or None, and count the hit or miss."""
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, response):
+        """Store a response and evict the least recently used ones beyond max_bytes."""
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is back under 90% of max_bytes."""
+        target = 0.9 * self.max_bytes
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used ASC").fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+
+    def report(self):
+        """Print hit/miss counters for this run."""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        print(f"Response cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+              f"{self.total_bytes / 1024 ** 2:.1f} MB stored.")
+
+    def close(self):
+        self.connection.close()
+
+def extract_entities_and_phrases(text, cache=None):
+    """
+    Use OpenAI's ChatGPT API to extract entities (perfume brands, product names) 
+    and descriptive phrases from text, formatted according to the provided schema.
+    When a ResponseCache is given, identical requests are answered from it.
+    """
+    request = build_request(text)
+    if cache is not None:
+        cache_key = cache.key(request)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    try:
+        response = openai.chat.completions.create(**request)
 
         # Correct response handling
-        return response.choices[0].message.content
+        result = response.choices[0].message.content
+        if cache is not None and result:
+            cache.put(cache_key, result)
+        return result
 
     except OpenAIError as e:
         print(f"An error occurred: {e}")
         return None
 
-def process_files(input_folder, output_folder):
+# Rough upper bound on the completion size, used only for tokens/min budgeting
+ESTIMATED_COMPLETION_TOKENS = 500
+
+def estimate_tokens(request):
+    """
+    Estimate the tokens a request will consume (about four characters per token
+    for the prompt, plus a fixed completion budget).
+    """
+    prompt_chars = sum(len(message["content"]) for message in request["messages"])
+    return prompt_chars // 4 + ESTIMATED_COMPLETION_TOKENS
+
+class TokenBucket:
+    """
+    Asyncio token bucket that refills continuously at rate_per_minute, with room
+    for one minute's worth of burst. acquire() waits until enough capacity is free.
+    """
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.refill_per_second = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.refill_per_second)
+
+def is_retryable(error):
+    """Return True for rate limit (429), server (5xx) and connection errors."""
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+def backoff_delay(attempt, error=None, base_delay=1.0, max_delay=60.0):
+    """
+    Exponential backoff with full jitter. A Retry-After header sent with the error
+    is used as a lower bound.
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+async def extract_entities_and_phrases_async(client, text, request_limiter=None, token_limiter=None, max_retries=5, cache=None):
+    """
+    Async variant of extract_entities_and_phrases. Waits on the request and token
+    rate limiters before each attempt and retries 429/5xx/connection errors with
+    exponential backoff and jitter. Cache hits skip the limiters entirely.
+    """
+    request = build_request(text)
+    if cache is not None:
+        cache_key = cache.key(request)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    for attempt in range(max_retries + 1):
+        if request_limiter:
+            await request_limiter.acquire()
+        if token_limiter:
+            await token_limiter.acquire(estimate_tokens(request))
+        try:
+            response = await client.chat.completions.create(**request)
+            result = response.choices[0].message.content
+            if cache is not None and result:
+                cache.put(cache_key, result)
+            return result
+        except OpenAIError as e:
+            if not is_retryable(e) or attempt == max_retries:
+                print(f"An error occurred: {e}")
+                return None
+            delay = backoff_delay(attempt, e)
+            print(f"Retryable error ({e.__class__.__name__}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+    return None
+
+def open_manifest(input_folder, output_folder, force=False):
+    """
+    Open the NER stage manifest and return it with the input files that still need
+    processing: new or changed inputs, or all of them when the prompt or schema
+    changed or force is set.
+    """
+    # The request built for an empty text fingerprints the model, prompt template and schema
+    manifest = StageManifest(output_folder, "ner", {"request": ResponseCache.key(build_request(""))})
+    file_names = [file_name for file_name in os.listdir(input_folder) if file_name.endswith(".json")]
+    pending = [
+        file_name for file_name in file_names
+        if force or not manifest.is_up_to_date(
+            file_name, [os.path.join(input_folder, file_name)], [os.path.join(output_folder, file_name)]
+        )
+    ]
+    print(f"{len(file_names) - len(pending)} of {len(file_names)} files already processed, {len(pending)} to process.")
+    return manifest, pending
+
+def save_result(input_folder, output_folder, file_name, result, manifest):
+    """Write an API result atomically and record it in the manifest."""
+    output_file_path = os.path.join(output_folder, file_name)
+    with atomic_write(output_file_path) as output_file:
+        # Assuming `result` is already a valid JSON structure (dictionary or list)
+        output_file.write(result)
+    manifest.record(file_name, [os.path.join(input_folder, file_name)], [output_file_path])
+    print(f"Saved results to {output_file_path}")
+
+def process_files(input_folder, output_folder, cache=None, force=False):
     """
     Process JSON files in a folder, extracting perfume brands, products, and phrases 
-    using ChatGPT, and save the results.
+    using ChatGPT, and save the results. Files already processed from the same input
+    are skipped unless force is set.
     """
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    for file_name in os.listdir(input_folder):
-        if file_name.endswith(".json"):
-            file_path = os.path.join(input_folder, file_name)
-            print(f"Processing {file_path}...")
+    manifest, file_names = open_manifest(input_folder, output_folder, force)
+    for file_name in file_names:
+        file_path = os.path.join(input_folder, file_name)
+        print(f"Processing {file_path}...")
+
+        # Load the JSON data
+        with open(file_path, 'r') as f:
+            data = json.load(f)
 
-            # Load the JSON data
+        # Extract entities and key phrases using ChatGPT
+        result = extract_entities_and_phrases(data.get("combined_text", ""), cache)
+
+        if result:
+            # Save the extracted information directly in JSON format
+            save_result(input_folder, output_folder, file_name, result, manifest)
+    manifest.compact()
+
+async def process_files_async(input_folder, output_folder, concurrency=8, requests_per_minute=None,
+                              tokens_per_minute=None, base_url=None, max_retries=5, cache=None, force=False):
+    """
+    Same as process_files, but sends up to `concurrency` requests at a time within
+    the given requests/min and tokens/min limits. base_url points the client at a
+    different OpenAI-compatible endpoint, e.g. a local mock server.
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    # Retries are handled here so that they also pass through the rate limiters
+    client = AsyncOpenAI(api_key=openai.api_key, base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+    request_limiter = TokenBucket(requests_per_minute) if requests_per_minute else None
+    token_limiter = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    async def process_file(file_name):
+        file_path = os.path.join(input_folder, file_name)
+        async with semaphore:
+            # Read inside the semaphore, so only `concurrency` files are in memory at a time
             with open(file_path, 'r') as f:
                 data = json.load(f)
+            print(f"Processing {file_path}...")
+            result = await extract_entities_and_phrases_async(
+                client, data.get("combined_text", ""), request_limiter, token_limiter, max_retries, cache
+            )
 
-            # Extract entities and key phrases using ChatGPT
-            result = extract_entities_and_phrases(data.get("combined_text", ""))
+        if result:
+            save_result(input_folder, output_folder, file_name, result, manifest)
+        return result is not None
 
-            if result:
-                # Save the extracted information directly in JSON format
-                output_file_path = os.path.join(output_folder, file_name)
-                with open(output_file_path, 'w') as output_file:
-                    # Assuming `result` is already a valid JSON structure (dictionary or list)
-                    output_file.write(result)
-                print(f"Saved results to {output_file_path}")
+    manifest, file_names = open_manifest(input_folder, output_folder, force)
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(process_file(file_name) for file_name in file_names))
+    finally:
+        await client.close()
+        manifest.compact()
+    elapsed = time.perf_counter() - start
+    print(f"Processed {sum(results)} of {len(file_names)} files in {elapsed:.1f}s.")
 
 def main():
     parser = argparse.ArgumentParser(description="Extract perfume brands, product names, and descriptive phrases using OpenAI GPT")
     parser.add_argument("input_folder", type=str, help="Path to folder containing the combined JSON files")
     parser.add_argument("output_folder", type=str, help="Path to folder to save the results")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent requests; values above 1 use the asyncio client (default: 1)")
+    parser.add_argument("--requests_per_minute", type=float, default=None, help="Request rate limit for the asyncio client (default: unlimited)")
+    parser.add_argument("--tokens_per_minute", type=float, default=None, help="Estimated token rate limit for the asyncio client (default: unlimited)")
+    parser.add_argument("--max_retries", type=int, default=5, help="Retries for 429/5xx responses in the asyncio client (default: 5)")
+    parser.add_argument("--cache_file", type=str, default="data/ner_cache.sqlite", help="SQLite file caching API responses (default: data/ner_cache.sqlite)")
+    parser.add_argument("--cache_max_mb", type=float, default=1024, help="Maximum size of cached responses in MB before eviction (default: 1024)")
+    parser.add_argument("--no_cache", action="store_true", help="Always call the API, bypassing the response cache")
+    parser.add_argument("--force", action="store_true", help="Reprocess every file, even those whose output is up to date")
+    parser.add_argument("--base_url", type=str, default=os.getenv("OPENAI_BASE_URL"), help="OpenAI-compatible API base URL, e.g. a local mock server (default: $OPENAI_BASE_URL)")
 
     args = parser.parse_args()
-    
-    # Process all files
-    process_files(args.input_folder, args.output_folder)
+
+    if args.base_url:
+        openai.base_url = args.base_url
+
+    cache = None if args.no_cache else ResponseCache(args.cache_file, int(args.cache_max_mb * 1024 ** 2))
+
+    if args.concurrency > 1:
+        asyncio.run(process_files_async(
+            args.input_folder, args.output_folder, args.concurrency, args.requests_per_minute,
+            args.tokens_per_minute, args.base_url, args.max_retries, cache, args.force
+        ))
+    else:
+        # Process all files
+        process_files(args.input_folder, args.output_folder, cache, args.force)
+
+    if cache is not None:
+        cache.report()
+        cache.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
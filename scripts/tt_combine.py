@@ -1,6 +1,7 @@
 import os
 import json
 import argparse
+from tt_manifest import StageManifest, atomic_write
 
 def load_json_file(file_path):
     """
@@ -27,23 +28,31 @@ def combine_transcription_and_ocr(transcription_data, ocr_text):
     }
     return combined_data
 
-def process_files(transcription_folder, ocr_folder, output_folder):
+def process_files(transcription_folder, ocr_folder, output_folder, force=False):
     """
     Process all transcription and OCR files in the specified folders, combine them,
-    and save the results into the output folder.
+    and save the results into the output folder. Files whose transcription and OCR
+    inputs are unchanged since the last run are skipped unless force is set.
     """
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
+    manifest = StageManifest(output_folder, "combine")
+    skipped = 0
     for file_name in os.listdir(transcription_folder):
         if file_name.endswith(".json"):
-            # Load the transcription JSON file
             transcription_path = os.path.join(transcription_folder, file_name)
+            ocr_file_name = file_name.replace('.json', '_text.txt')
+            ocr_path = os.path.join(ocr_folder, ocr_file_name)
+            output_file_path = os.path.join(output_folder, file_name)
+            if not force and manifest.is_up_to_date(file_name, [transcription_path, ocr_path], [output_file_path]):
+                skipped += 1
+                continue
+
+            # Load the transcription JSON file
             transcription_data = load_json_file(transcription_path)
 
             # Load the corresponding OCR text file
-            ocr_file_name = file_name.replace('.json', '-text.txt')
-            ocr_path = os.path.join(ocr_folder, ocr_file_name)
             if os.path.exists(ocr_path):
                 ocr_text = load_text_file(ocr_path)
             else:
@@ -53,23 +62,27 @@ def process_files(transcription_folder, ocr_folder, output_folder):
             combined_data = combine_transcription_and_ocr(transcription_data, ocr_text)
 
             # Save the combined data as a new JSON file in the output folder
-            output_file_path = os.path.join(output_folder, file_name)
-            with open(output_file_path, 'w') as output_file:
+            with atomic_write(output_file_path) as output_file:
                 json.dump(combined_data, output_file, indent=4)
+            manifest.record(file_name, [transcription_path, ocr_path], [output_file_path])
 
             print(f"Combined and saved data for {file_name}")
 
+    manifest.compact()
+    print(f"Skipped {skipped} files that were already up to date.")
+
 def main():
     # Set up argparse for command-line arguments
     parser = argparse.ArgumentParser(description="Combine transcription and OCR text files into a unified format")
     parser.add_argument("transcription_folder", type=str, help="Path to the folder containing transcription JSON files.")
     parser.add_argument("ocr_folder", type=str, help="Path to the folder containing OCR text files.")
     parser.add_argument("output_folder", type=str, help="Path to the folder where combined JSON files will be saved.")
+    parser.add_argument("--force", action="store_true", help="Recombine every file, even those that are up to date.")
 
     args = parser.parse_args()
 
     # Process all files in the transcription and OCR folders
-    process_files(args.transcription_folder, args.ocr_folder, args.output_folder)
+    process_files(args.transcription_folder, args.ocr_folder, args.output_folder, args.force)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,18 +1,68 @@
 import json
 import re
 import os
+import time
 import pandas as pd
 import argparse
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from nltk import download
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tt_manifest import atomic_write
+from tt_io import table_format, arrow_table
 
-# Download NLTK resources if not already downloaded
-download('stopwords')
-download('wordnet')
-download('omw-1.4')
+# NLTK resources are loaded lazily on first use from this local cache directory.
+# In offline mode they are never downloaded; fetch them once with --prefetch.
+nltk_data_dir = os.environ.get('NLTK_DATA', os.path.join(os.path.expanduser('~'), 'nltk_data'))
+nltk_offline = os.environ.get('NLTK_OFFLINE', '') not in ('', '0')
 
-nltk_stop_words = set(stopwords.words('english'))
+# NLTK package name -> resource path checked before downloading
+nltk_resources = {
+    'stopwords': 'corpora/stopwords',
+    'wordnet': 'corpora/wordnet',
+    'omw-1.4': 'corpora/omw-1.4',
+}
+
+def configure_nltk(data_dir=None, offline=None):
+    """Override the NLTK cache directory and/or offline mode before first use."""
+    global nltk_data_dir, nltk_offline
+    if data_dir is not None:
+        nltk_data_dir = data_dir
+    if offline is not None:
+        nltk_offline = offline
+
+def ensure_nltk_resource(name):
+    """
+    Make sure an NLTK resource is available locally, downloading it into the cache
+    directory unless running offline.
+    """
+    import nltk
+    if nltk_data_dir not in nltk.data.path:
+        nltk.data.path.insert(0, nltk_data_dir)
+    try:
+        # WordNet-based resources may be shipped zipped only
+        nltk.data.find(nltk_resources[name])
+        return
+    except LookupError:
+        try:
+            nltk.data.find(f"{nltk_resources[name]}.zip")
+            return
+        except LookupError:
+            pass
+    if nltk_offline:
+        raise LookupError(
+            f"NLTK resource '{name}' not found in {nltk_data_dir} and offline mode is on. "
+            f"Run 'tt_data_preprocess.py --prefetch' on a machine with network access first."
+        )
+    print(f"Downloading NLTK resource '{name}' to {nltk_data_dir}...")
+    if not nltk.download(name, download_dir=nltk_data_dir, quiet=True):
+        raise LookupError(f"Could not download NLTK resource '{name}'.")
+
+def prefetch_nltk_resources():
+    """Download every NLTK resource the preprocessing needs into the cache directory."""
+    for name in nltk_resources:
+        ensure_nltk_resource(name)
+    print(f"NLTK resources available in {nltk_data_dir}")
 
 # Custom stop words specific to perfume descriptions
 custom_stop_words = {
@@ -49,38 +99,158 @@ custom_stop_words = {
     'twist','insanely','brush'
     }
 
-# Combined stop words (NLTK + custom)
-all_stop_words = nltk_stop_words.union(custom_stop_words)
-
-def load_and_preprocess(data_folders):
-    # Aggregate data from all specified folders
-    data = []
-    for folder in data_folders:
-        for file_name in os.listdir(folder):
-            if file_name.endswith('.json'):
-                file_path = os.path.join(folder, file_name)
-                with open(file_path, 'r') as f:
-                    content = json.load(f)
-                    data.extend(content['data'])
-
-    # Preprocess descriptors
-    def preprocess(text):
-        text = text.lower()
-        # Remove punctuation, numbers, special characters
-        text = re.sub(r'[^a-zA-Z\s]', '', text)
-        words = text.split()
-        lemmatizer = WordNetLemmatizer()
-        # Remove stop words, words of length <= 1, and lemmatize
-        filtered_words = [
-            lemmatizer.lemmatize(word)
-            for word in words
-            if word not in all_stop_words and len(word) > 1
-        ]
-        return ' '.join(filtered_words)
+@lru_cache(maxsize=None)
+def get_stop_words():
+    """Combined stop words (NLTK + custom), loaded on first use."""
+    ensure_nltk_resource('stopwords')
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english')).union(custom_stop_words)
+
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    """One WordNet lemmatizer for the whole process, loaded on first use."""
+    ensure_nltk_resource('wordnet')
+    ensure_nltk_resource('omw-1.4')
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+# Matches punctuation, numbers and special characters
+non_letter_pattern = re.compile(r'[^a-zA-Z\s]')
+
+@lru_cache(maxsize=2 ** 18)
+def normalize_word(word):
+    """
+    Return the lemma of a lowercase word, or an empty string for stop words and
+    words of length <= 1. Cached, since descriptor vocabularies are small and
+    highly repetitive.
+    """
+    if word in get_stop_words() or len(word) <= 1:
+        return ''
+    return get_lemmatizer().lemmatize(word)
+
+# Preprocess descriptors
+def preprocess(text):
+    text = text.lower()
+    # Remove punctuation, numbers, special characters
+    text = non_letter_pattern.sub('', text)
+    # Remove stop words, words of length <= 1, and lemmatize
+    filtered_words = [lemma for lemma in map(normalize_word, text.split()) if lemma]
+    return ' '.join(filtered_words)
+
+def preprocess_chunk(texts):
+    """Preprocess a list of descriptor strings (the unit of work for worker processes)."""
+    return [preprocess(text) for text in texts]
+
+def preprocess_series(descriptors, workers=1, chunk_size=50000):
+    """
+    Preprocess a Series of descriptors. Each distinct string is processed once and
+    the results are mapped back onto the Series. With workers > 1 the distinct
+    strings are split into chunks of chunk_size and processed in a process pool.
+    """
+    unique_texts = pd.unique(descriptors).tolist()
+    if workers > 1 and len(unique_texts) > chunk_size:
+        chunks = [unique_texts[i:i + chunk_size] for i in range(0, len(unique_texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            processed = [text for chunk in executor.map(preprocess_chunk, chunks) for text in chunk]
+    else:
+        processed = preprocess_chunk(unique_texts)
+    return descriptors.map(dict(zip(unique_texts, processed)))
+
+# Columns of the NER output records
+output_columns = ['brand', 'perfume_name', 'descriptors']
+
+def load_records(file_path):
+    """
+    Load the records of one NER output file. Unreadable or malformed files are
+    reported and skipped by returning an empty list.
+    """
+    try:
+        with open(file_path, 'r') as f:
+            content = json.load(f)
+        records = content['data']
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise TypeError("'data' is not a list of objects")
+        return records
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Skipping {file_path}: {e.__class__.__name__}: {e}")
+        return []
+
+def iter_records(data_folders, read_threads=4):
+    """
+    Yield the NER records of every JSON file in the folders. Files are parsed in a
+    thread pool, with only a small window of files in flight at a time.
+    """
+    file_paths = (
+        os.path.join(folder, file_name)
+        for folder in data_folders
+        for file_name in os.listdir(folder)
+        if file_name.endswith('.json')
+    )
+    with ThreadPoolExecutor(max_workers=read_threads) as executor:
+        in_flight = deque()
+        for file_path in file_paths:
+            in_flight.append(executor.submit(load_records, file_path))
+            if len(in_flight) >= read_threads * 4:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+def iter_preprocessed_chunks(data_folders, chunk_size=100000, workers=1, read_threads=4):
+    """
+    Yield DataFrames of at most chunk_size records with preprocessed descriptors,
+    so memory stays bounded by the chunk size rather than the corpus size.
+    """
+    records = iter_records(data_folders, read_threads)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        df = pd.DataFrame(chunk).reindex(columns=output_columns)
+        df['descriptors'] = preprocess_series(df['descriptors'].fillna('').astype(str), workers)
+        yield df
+
+def preprocess_to_file(data_folders, output_file, chunk_size=100000, workers=1, read_threads=4):
+    """
+    Stream the NER records through preprocessing chunk by chunk and append each chunk
+    to output_file, as CSV or, for a .parquet path, as Parquet row groups with brand and
+    perfume_name dictionary-encoded. The file is moved into place only once complete.
+    Returns the number of rows written.
+    """
+    file_format = table_format(output_file)
+    if file_format == 'feather':
+        raise ValueError("Feather output cannot be written chunk by chunk; use a .parquet or .csv path.")
+    parquet = file_format == 'parquet'
+    rows = 0
+    with atomic_write(output_file, 'wb' if parquet else 'w') as f:
+        writer = None
+        for df in iter_preprocessed_chunks(data_folders, chunk_size, workers, read_threads):
+            if parquet:
+                import pyarrow.parquet as pq
+                table = arrow_table(df)
+                if writer is None:
+                    writer = pq.ParquetWriter(f, table.schema)
+                writer.write_table(table)
+            else:
+                df.to_csv(f, index=False, header=rows == 0)
+            rows += len(df)
+            print(f"Preprocessed {rows} rows...")
+        if parquet and writer is not None:
+            writer.close()
+        elif parquet:
+            # No records: still write a valid file with the expected columns
+            import pyarrow.parquet as pq
+            pq.write_table(arrow_table(pd.DataFrame({column: pd.Series(dtype='str') for column in output_columns})), f)
+        elif rows == 0:
+            f.write(','.join(output_columns) + '\n')
+    return rows
+
+def load_and_preprocess(data_folders, workers=1):
+    # Aggregate data from all specified folders; malformed files are skipped
+    data = list(iter_records(data_folders))
 
     # Convert to DataFrame and preprocess descriptors
     df = pd.DataFrame(data)
-    df['descriptors'] = df['descriptors'].apply(preprocess)
+    df['descriptors'] = preprocess_series(df['descriptors'], workers)
     return df
 
 if __name__ == "__main__":
@@ -88,21 +258,65 @@ if __name__ == "__main__":
     parser.add_argument(
         'data_folders',
         type=str,
-        nargs='+',
+        nargs='*',
         help="List of paths to folders containing JSON data files."
     )
     parser.add_argument(
         '--output_file',
         type=str,
         default='processed_descriptors.csv',
-        help="Path for the output CSV file (default: processed_descriptors.csv)"
+        help="Path for the output CSV file, or a .parquet file (default: processed_descriptors.csv)"
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=100000,
+        help="Number of records preprocessed and written at a time (default: 100000)"
+    )
+    parser.add_argument(
+        '--read_threads',
+        type=int,
+        default=4,
+        help="Number of threads parsing JSON files (default: 4)"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of processes used to preprocess descriptors (default: 1)"
+    )
+    parser.add_argument(
+        '--nltk_data',
+        type=str,
+        default=None,
+        help="Local NLTK cache directory (default: $NLTK_DATA or ~/nltk_data)"
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help="Never download NLTK resources; fail if they are missing from the cache (also NLTK_OFFLINE=1)"
+    )
+    parser.add_argument(
+        '--prefetch',
+        action='store_true',
+        help="Download the NLTK resources into the cache directory and exit"
     )
 
     args = parser.parse_args()
+    configure_nltk(args.nltk_data, True if args.offline else None)
+
+    if args.prefetch:
+        prefetch_nltk_resources()
+        raise SystemExit(0)
+    if not args.data_folders:
+        parser.error("at least one data folder is required")
 
-    # Load and preprocess data from multiple folders
-    df = load_and_preprocess(args.data_folders)
+    # Load the NLTK resources up front so their cost is reported separately
+    resources_start = time.perf_counter()
+    get_stop_words()
+    get_lemmatizer().lemmatize('warmup')
+    print(f"NLTK resources loaded in {time.perf_counter() - resources_start:.2f}s.")
 
-    # Save processed data to a CSV file
-    df.to_csv(args.output_file, index=False)
-    print(f"Data preprocessed and saved to {args.output_file}")
\ No newline at end of file
+    # Load, preprocess and save data from multiple folders, one chunk at a time
+    rows = preprocess_to_file(args.data_folders, args.output_file, args.chunk_size, args.workers, args.read_threads)
+    print(f"Data preprocessed ({rows} rows) and saved to {args.output_file}")
\ No newline at end of file
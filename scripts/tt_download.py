@@ -1,26 +1,20 @@
 import argparse
 import os
+import re
+import json
+import queue
 import yt_dlp
 import time
 import random
+import threading
+from urllib.parse import urlparse
 
-def main():
-    parser = argparse.ArgumentParser(description='Download TikTok videos from a list of URLs.')
-    parser.add_argument('input_file', help='Path to the input txt file containing TikTok URLs.')
-    parser.add_argument('output_dir', help='Directory to save downloaded videos.')
-    parser.add_argument('--cookies', help='Path to cookies.txt file for authentication (optional).')
-    args = parser.parse_args()
-    
-    # Read URLs from the input file
-    with open(args.input_file, 'r') as f:
-        urls = [line.strip() for line in f if line.strip()]
-        
-    # Create the output directory if it doesn't exist
-    os.makedirs(args.output_dir, exist_ok=True)
-    
-    # Set up yt_dlp options
+def build_ydl_options(output_dir, cookies=None):
+    """
+    Build the yt_dlp options used to download TikTok videos into output_dir.
+    """
     ydl_opts = {
-        'outtmpl': os.path.join(args.output_dir, '%(title).60s [%(id)s].%(ext)s'),
+        'outtmpl': os.path.join(output_dir, '%(title).60s [%(id)s].%(ext)s'),
         'format': 'bestvideo+bestaudio/best',
         'trim_file_name': 100,  # Max length of the filename (excluding extension)
         'restrictfilenames': True,  # Restrict filenames to ASCII characters and avoid special characters
@@ -41,30 +35,243 @@ def main():
     }
 
     # Add cookies if provided
-    if args.cookies:
-        ydl_opts['cookiefile'] = args.cookies
-        
-    # Download each video using yt_dlp
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        for url in urls:
-            attempts = 0
-            while attempts < 3:
+    if cookies:
+        ydl_opts['cookiefile'] = cookies
+    return ydl_opts
+
+def downloaded_file_path(ydl, info):
+    """
+    Return the path of the file yt_dlp wrote for a downloaded video.
+    """
+    requested = info.get('requested_downloads')
+    if requested and requested[0].get('filepath'):
+        return requested[0]['filepath']
+    return ydl.prepare_filename(info)
+
+def fetch_video(ydl, url):
+    """
+    Download one URL with a single attempt and return the downloaded file path.
+    Errors are raised to the caller.
+    """
+    info = ydl.extract_info(url, download=True)
+    return downloaded_file_path(ydl, info)
+
+def download_video(ydl, url, max_attempts=3):
+    """
+    Download one URL with retries and return the downloaded file path, or None
+    if every attempt failed.
+    """
+    attempts = 0
+    while attempts < max_attempts:
+        try:
+            print(f'Downloading {url}')
+            video_path = fetch_video(ydl, url)
+            # Sleep for a random duration between 5 to 10 seconds
+            time.sleep(random.uniform(5, 10))
+            return video_path
+        except yt_dlp.utils.DownloadError as e:
+            attempts += 1
+            print(f'Error downloading {url}: {e}')
+            # Sleep before retrying
+            time.sleep(random.uniform(10, 15))
+            if attempts >= max_attempts:
+                print(f'Failed to download {url} after {attempts} attempts.')
+        except Exception as e:
+            print(f'Unexpected error downloading {url}: {e}')
+            break  # Break on unexpected errors
+    return None
+
+def video_id_from_url(url):
+    """
+    Return the TikTok video ID of a URL, or the URL itself when it has none.
+    """
+    match = re.search(r'/video/(\d+)', url) or re.search(r'(\d{15,})', url)
+    return match.group(1) if match else url
+
+def is_throttled(error):
+    """Return True if a download error is a rate limit (HTTP 429) response."""
+    message = str(error)
+    return '429' in message or 'Too Many Requests' in message
+
+class HostPacer:
+    """
+    Spaces out request starts per host and adapts the gap to how the host responds:
+    every success shrinks it by 20% (down to min_delay), every error grows it by
+    half and a 429 doubles it (up to max_delay). Random jitter of up to 50% is added to
+    each gap.
+    """
+    def __init__(self, initial_delay=5.0, min_delay=0.5, max_delay=120.0):
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delays = {}
+        self.next_start = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        """Block until the next request to host may start, and reserve that slot."""
+        with self.lock:
+            delay = self.delays.setdefault(host, self.initial_delay)
+            now = time.monotonic()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + delay * random.uniform(1.0, 1.5)
+        time.sleep(max(0.0, start - now))
+
+    def success(self, host):
+        with self.lock:
+            self.delays[host] = max(self.min_delay, self.delays.get(host, self.initial_delay) * 0.8)
+
+    def failure(self, host, throttled=False):
+        with self.lock:
+            factor = 2.0 if throttled else 1.5
+            self.delays[host] = min(self.max_delay, self.delays.get(host, self.initial_delay) * factor)
+
+class DownloadLedger:
+    """
+    Append-only JSON Lines record of finished downloads, keyed by video ID, so a
+    rerun skips videos that were already downloaded (and, optionally, ones that
+    failed for good).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Line cut short by a crash
+                    self.entries[entry['id']] = entry
+
+    def status(self, video_id):
+        entry = self.entries.get(video_id)
+        return entry['status'] if entry else None
+
+    def record(self, video_id, url, status, path=None, error=None):
+        entry = {'id': video_id, 'url': url, 'status': status, 'path': path, 'error': error, 'time': time.time()}
+        with self.lock:
+            self.entries[video_id] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+def download_all(urls, output_dir, cookies=None, workers=4, ledger=None, pacer=None, max_attempts=3,
+                 retry_failed=False, fetch=fetch_video):
+    """
+    Download URLs with a pool of worker threads, each with its own YoutubeDL.
+    Request starts are paced per host by the HostPacer, failed URLs are put back on
+    the queue until max_attempts, and every finished URL is written to the ledger.
+    Returns the number of videos downloaded and failed in this run.
+    """
+    pacer = pacer or HostPacer()
+    pending = []
+    for url in urls:
+        status = ledger.status(video_id_from_url(url)) if ledger else None
+        if status == 'done' or (status == 'failed' and not retry_failed):
+            continue
+        pending.append(url)
+    print(f'{len(urls) - len(pending)} of {len(urls)} URLs already in the ledger, {len(pending)} to download.')
+    if not pending:
+        return 0, 0
+
+    work_queue = queue.Queue()
+    for url in pending:
+        work_queue.put((url, 1))
+    stats = {'done': 0, 'failed': 0, 'retries': 0, 'remaining': len(pending)}
+    stats_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def report():
+        elapsed = time.perf_counter() - start
+        rate = stats['done'] / elapsed * 60 if elapsed > 0 else 0.0
+        delays = ', '.join(f'{host}: {delay:.1f}s' for host, delay in pacer.delays.items())
+        print(f"[{elapsed:.0f}s] {stats['done']} downloaded, {stats['failed']} failed, {stats['retries']} retries, "
+              f"{stats['remaining']} remaining, {rate:.1f} videos/min (delays {delays or 'n/a'})")
+
+    def finish(url, status, path=None, error=None):
+        try:
+            if ledger:
+                ledger.record(video_id_from_url(url), url, status, path, error)
+        except Exception as e:
+            # The URL still counts as finished, or the workers would wait for it forever
+            print(f'Could not record {url} in the ledger: {e}')
+        with stats_lock:
+            stats[status if status == 'failed' else 'done'] += 1
+            stats['remaining'] -= 1
+            if (stats['done'] + stats['failed']) % 25 == 0:
+                report()
+
+    def worker():
+        with yt_dlp.YoutubeDL(build_ydl_options(output_dir, cookies)) as ydl:
+            while True:
+                with stats_lock:
+                    if stats['remaining'] == 0:
+                        return
                 try:
-                    print(f'Downloading {url}')
-                    ydl.download([url])
-                    # Sleep for a random duration between 5 to 10 seconds
-                    time.sleep(random.uniform(5, 10))
-                    break  # Break out of the retry loop if successful
-                except yt_dlp.utils.DownloadError as e:
-                    attempts += 1
-                    print(f'Error downloading {url}: {e}')
-                    # Sleep before retrying
-                    time.sleep(random.uniform(10, 15))
-                    if attempts >= 3:
-                        print(f'Failed to download {url} after {attempts} attempts.')
+                    url, attempt = work_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue  # Another worker still holds a URL that may be retried
+                try:
+                    download_one(ydl, url, attempt)
                 except Exception as e:
-                    print(f'Unexpected error downloading {url}: {e}')
-                    break  # Break on unexpected errors
+                    # Anything outside the download itself failing must still finish the URL
+                    print(f'Unexpected error handling {url}: {e}')
+                    finish(url, 'failed', error=str(e))
+
+    def download_one(ydl, url, attempt):
+        host = urlparse(url).netloc
+        pacer.wait(host)
+        try:
+            print(f'Downloading {url} (attempt {attempt})')
+            path = fetch(ydl, url)
+        except Exception as e:
+            throttled = is_throttled(e)
+            pacer.failure(host, throttled)
+            print(f'Error downloading {url}: {e}')
+            if attempt < max_attempts and (throttled or isinstance(e, yt_dlp.utils.DownloadError)):
+                with stats_lock:
+                    stats['retries'] += 1
+                work_queue.put((url, attempt + 1))
+            else:
+                print(f'Failed to download {url} after {attempt} attempts.')
+                finish(url, 'failed', error=str(e))
+            return
+        pacer.success(host)
+        finish(url, 'done', path)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(workers, len(pending)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report()
+    return stats['done'], stats['failed']
+
+def main():
+    parser = argparse.ArgumentParser(description='Download TikTok videos from a list of URLs.')
+    parser.add_argument('input_file', help='Path to the input txt file containing TikTok URLs.')
+    parser.add_argument('output_dir', help='Directory to save downloaded videos.')
+    parser.add_argument('--cookies', help='Path to cookies.txt file for authentication (optional).')
+    parser.add_argument('--workers', type=int, default=4, help='Number of concurrent downloads (default: 4).')
+    parser.add_argument('--initial_delay', type=float, default=5.0, help='Starting gap in seconds between requests to the same host (default: 5).')
+    parser.add_argument('--min_delay', type=float, default=0.5, help='Smallest gap the pacer may shrink to after successes (default: 0.5).')
+    parser.add_argument('--max_delay', type=float, default=120.0, help='Largest gap the pacer may grow to after errors (default: 120).')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Attempts per URL before it is marked as failed (default: 3).')
+    parser.add_argument('--ledger', help='Path of the done/failed ledger (default: download_ledger.jsonl in output_dir).')
+    parser.add_argument('--retry_failed', action='store_true', help='Retry URLs the ledger marks as failed.')
+    args = parser.parse_args()
+    
+    # Read URLs from the input file
+    with open(args.input_file, 'r') as f:
+        urls = [line.strip() for line in f if line.strip()]
+        
+    # Create the output directory if it doesn't exist
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    ledger = DownloadLedger(args.ledger or os.path.join(args.output_dir, 'download_ledger.jsonl'))
+    pacer = HostPacer(args.initial_delay, args.min_delay, args.max_delay)
+    download_all(urls, args.output_dir, args.cookies, args.workers, ledger, pacer, args.max_attempts, args.retry_failed)
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
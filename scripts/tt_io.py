@@ -0,0 +1,161 @@
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from tt_manifest import atomic_write
+
+# Columns stored as dictionary-encoded categoricals in the columnar formats
+categorical_columns = ['brand', 'perfume_name']
+
+def table_format(path):
+    """Return 'parquet', 'feather' or 'csv' depending on the file extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    if extension in ('.feather', '.arrow'):
+        return 'feather'
+    return 'csv'
+
+def arrow_table(df):
+    """
+    Convert a DataFrame to a pyarrow Table with brand and perfume_name dictionary-encoded.
+    Dictionary indices are always int32, so tables built from different chunks share one
+    schema and can be appended to the same Parquet file.
+    """
+    import pyarrow as pa
+    df = df.reset_index(drop=True)
+    for column in categorical_columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = [
+        pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+        if field.name in categorical_columns else field
+        for field in table.schema
+    ]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+def read_table(path):
+    """
+    Read a table written by write_table (or any CSV). Parquet and Feather files keep
+    their column types, so brand and perfume_name come back as categoricals and
+    descriptors as strings with real missing values.
+    """
+    file_format = table_format(path)
+    if file_format == 'csv':
+        return pd.read_csv(path)
+    df = pd.read_parquet(path) if file_format == 'parquet' else pd.read_feather(path)
+    for column in categorical_columns:
+        if column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype):
+            # Row groups carry their own dictionaries; sort the merged categories so
+            # groupby orders perfumes the same way as it does for CSV input
+            df[column] = df[column].cat.reorder_categories(sorted(df[column].cat.categories))
+    return df
+
+def iter_table_chunks(path, chunk_size=100000):
+    """
+    Yield a table as DataFrames of at most chunk_size rows. CSV files are parsed and
+    Parquet files decoded one chunk at a time; Feather files are memory-mapped.
+    """
+    file_format = table_format(path)
+    if file_format == 'csv':
+        yield from pd.read_csv(path, chunksize=chunk_size)
+    elif file_format == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import pyarrow.feather as feather
+        table = feather.read_table(path, memory_map=True)
+        for start in range(0, table.num_rows, chunk_size):
+            yield table.slice(start, chunk_size).to_pandas()
+
+def write_table(df, path):
+    """
+    Write a DataFrame as CSV, Parquet or Feather depending on the extension of path.
+    The file is moved into place only once complete.
+    """
+    file_format = table_format(path)
+    if file_format == 'csv':
+        with atomic_write(path) as f:
+            df.to_csv(f, index=False)
+        return
+
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    table = arrow_table(df)
+    with atomic_write(path, 'wb') as f:
+        if file_format == 'parquet':
+            pq.write_table(table, f)
+        else:
+            feather.write_feather(table, f)
+
+def save_arrays(path, arrays, meta=None):
+    """
+    Save a dict of numpy arrays as a folder of .npy files plus a meta.json, so each
+    array can later be memory-mapped instead of deserialized. meta.json is written
+    last and lists the arrays, so a folder cut short by a crash is not mistaken for
+    a complete one.
+    """
+    if path.endswith('.pkl'):
+        raise ValueError(f"{path}: matrices are stored as a folder of .npy files now; pass a path without .pkl")
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        # Invalidate the previous contents until every new array is in place
+        os.remove(meta_path)
+    for name, array in arrays.items():
+        with atomic_write(os.path.join(path, f"{name}.npy"), 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+    meta = dict(meta or {})
+    meta['arrays'] = sorted(arrays)
+    with atomic_write(meta_path) as f:
+        json.dump(meta, f, indent=4)
+
+def load_arrays(path, mmap=True):
+    """
+    Load a folder written by save_arrays and return (arrays, meta). With mmap the
+    arrays are opened read-only with mmap_mode='r', so processes share one copy
+    through the page cache. A legacy .pkl file holding a dict of arrays is still
+    accepted.
+    """
+    if os.path.isfile(path) and path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        return {name: value for name, value in data.items() if isinstance(value, np.ndarray)}, {}
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None)
+        for name in meta['arrays']
+    }
+    return arrays, meta
+
+def save_sparse_matrix(path, matrix, meta=None, arrays=None):
+    """
+    Save a sparse matrix as its CSR data/indices/indptr arrays (see save_arrays), with
+    any further arrays stored next to them.
+    """
+    import scipy.sparse as sp
+    matrix = sp.csr_matrix(matrix, copy=True)
+    # Store sorted, duplicate-free indices: scipy would otherwise sort them in place,
+    # which fails on read-only memory-mapped arrays
+    matrix.sum_duplicates()
+    meta = dict(meta or {})
+    meta['shape'] = list(matrix.shape)
+    arrays = dict(arrays or {})
+    arrays.update(data=matrix.data, indices=matrix.indices, indptr=matrix.indptr)
+    save_arrays(path, arrays, meta)
+
+def load_sparse_matrix(path, mmap=True):
+    """
+    Load a CSR matrix written by save_sparse_matrix. With mmap its arrays stay on disk
+    and are paged in as they are used. A legacy pickled matrix is still accepted.
+    """
+    import scipy.sparse as sp
+    if os.path.isfile(path) and path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return sp.csr_matrix(pickle.load(f))
+    arrays, meta = load_arrays(path, mmap)
+    return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']), copy=False)
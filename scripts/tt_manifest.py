@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a temporary file next to `path` for writing and move it into place only
+    when the block finishes without an error, so a killed run never leaves a
+    truncated output file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 of a file's content, reading it in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_fingerprint(path, previous=None):
+    """
+    Return the size, modification time and content hash of a file, or None if it
+    does not exist. When size and mtime match a previous fingerprint, its hash is
+    reused instead of re-reading the file.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        fingerprint["sha256"] = previous["sha256"]
+    else:
+        fingerprint["sha256"] = file_hash(path)
+    return fingerprint
+
+class StageManifest:
+    """
+    Per-stage record of which inputs have been processed into which outputs.
+
+    Entries are appended to a JSON Lines journal in the stage's output folder as
+    soon as an item finishes, so a crashed run resumes where it stopped. An item
+    is up to date when its recorded input fingerprints still match, its outputs
+    still exist and the stage parameters (model, sampling settings, ...) are
+    unchanged.
+    """
+    def __init__(self, output_folder, stage, params=None):
+        self.path = os.path.join(output_folder, f".manifest_{stage}.jsonl")
+        self.params = params or {}
+        self.entries = {}
+        damaged = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        damaged = True  # Line cut short by a crash
+                        continue
+                    self.entries[entry["key"]] = entry
+        if damaged:
+            self.compact()
+
+    def is_up_to_date(self, key, input_paths, output_paths):
+        """Return True if `key` was processed from unchanged inputs with the same parameters."""
+        entry = self.entries.get(key)
+        if entry is None or entry.get("params") != self.params:
+            return False
+        if sorted(entry["outputs"]) != sorted(output_paths) or not all(os.path.exists(p) for p in output_paths):
+            return False
+        for path in input_paths:
+            recorded = entry["inputs"].get(path)
+            if not os.path.exists(path):
+                if recorded is not None:
+                    return False
+                continue
+            if recorded is None:
+                return False
+            stat = os.stat(path)
+            if stat.st_size == recorded["size"] and stat.st_mtime_ns == recorded["mtime_ns"]:
+                continue
+            # Touched but possibly unchanged: fall back to comparing content
+            if stat.st_size != recorded["size"] or file_hash(path) != recorded["sha256"]:
+                return False
+        return True
+
+    def record(self, key, input_paths, output_paths):
+        """Append a finished item to the journal."""
+        previous = self.entries.get(key, {}).get("inputs", {})
+        entry = {
+            "key": key,
+            "inputs": {path: file_fingerprint(path, previous.get(path)) for path in input_paths},
+            "outputs": list(output_paths),
+            "params": self.params,
+        }
+        self.entries[key] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        """Rewrite the journal with only the latest entry per item."""
+        with atomic_write(self.path) as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
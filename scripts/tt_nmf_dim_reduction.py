@@ -1,28 +1,339 @@
-import pickle
-from sklearn.decomposition import NMF
+import os
+import time
+import hashlib
+import warnings
+import numpy as np
+from sklearn.decomposition import NMF, MiniBatchNMF, non_negative_factorization
+from sklearn.exceptions import ConvergenceWarning
 import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
+from tt_io import load_sparse_matrix, load_arrays, save_arrays, write_table
+from tt_manifest import file_hash
 
-def perform_nmf(tfidf_matrix_file, n_topics, output_nmf_file):
+def reconstruction_error(X, W, H):
+    """
+    Frobenius norm of X - W H, computed from the sparse X without forming W H:
+    ||X||^2 - 2 tr(W^T X H^T) + tr(W^T W H H^T).
+    """
+    squared = (
+        X.multiply(X).sum()
+        - 2 * np.sum(W * (X @ H.T))
+        + np.sum((W.T @ W) * (H @ H.T))
+    )
+    return float(np.sqrt(max(squared, 0.0)))
+
+def log_iteration(history, iteration, start, X, W, H):
+    """Record and print the elapsed time and reconstruction error after an iteration."""
+    history.append([iteration, time.perf_counter() - start, reconstruction_error(X, W, H)])
+    print(f"  iteration {iteration:4d}: {history[-1][1]:8.2f}s, reconstruction error {history[-1][2]:.6f}")
+
+def tfidf_state(tfidf_matrix_file):
+    """Row hashes and an IDF checksum of the TF-IDF folder, used to find rows to refresh."""
+    if not os.path.isdir(tfidf_matrix_file):
+        return None, None  # Legacy pickled matrix
+    arrays, _ = load_arrays(tfidf_matrix_file)
+    idf_hash = hashlib.sha1(np.ascontiguousarray(arrays['idf']).tobytes()).hexdigest() if 'idf' in arrays else None
+    return arrays.get('row_hashes'), idf_hash
+
+def rows_to_refresh(n_rows, row_hashes, idf_hash, previous, previous_meta):
+    """
+    Return the rows of the TF-IDF matrix that the previous factorization does not cover:
+    rows appended since, rows whose content hash changed and, if the IDF was refitted
+    (every row rescaled), all rows.
+    """
+    n_previous = previous['W'].shape[0]
+    if n_previous > n_rows:
+        raise ValueError("The TF-IDF matrix has fewer rows than the previous factorization; run --mode full.")
+    if idf_hash is None or idf_hash != previous_meta.get('idf_hash'):
+        return np.arange(n_rows)
+    rows = np.arange(n_previous, n_rows)
+    if row_hashes is not None and 'row_hashes' in previous:
+        changed = np.flatnonzero(np.asarray(row_hashes[:n_previous]) != np.asarray(previous['row_hashes']))
+        rows = np.concatenate([changed, rows])
+    return rows
+
+def fit_nmf(X, n_topics, max_iter, tol, W=None, H=None, log_every=0):
+    """
+    Fit NMF with sklearn's solver, from (W, H) when given (warm start) or from the
+    default NNDSVD initialization, and return (W, H, history). History entries are
+    [iteration, elapsed seconds, reconstruction error].
+
+    By default the solver runs once with its own tol and max_iter, and only the final
+    error is recorded. With log_every > 0 the fit runs in segments of log_every
+    iterations, each warm-started from the previous one, and the error is logged after
+    every segment. sklearn then checks tol per segment, so the result can differ
+    slightly from a single fit, and each logged point costs an error evaluation.
+    """
+    def fit_segment(W, H, iterations):
+        if W is None:
+            model = NMF(n_components=n_topics, random_state=42, max_iter=iterations, tol=tol)
+            return model, model.fit_transform(X)
+        model = NMF(n_components=n_topics, init='custom', random_state=42, max_iter=iterations, tol=tol)
+        return model, model.fit_transform(X, W=W, H=H)
+
+    history = []
+    start = time.perf_counter()
+    if log_every <= 0:
+        model, W = fit_segment(W, H, max_iter)
+        history.append([int(model.n_iter_), time.perf_counter() - start, float(model.reconstruction_err_)])
+        return W, model.components_, history
+
+    iteration = 0
+    with warnings.catch_warnings():
+        # Every segment but the last stops at its iteration limit on purpose
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        while iteration < max_iter:
+            segment = min(log_every, max_iter - iteration)
+            model, W = fit_segment(W, H, segment)
+            H = model.components_
+            iteration += int(model.n_iter_)
+            log_iteration(history, iteration, start, X, W, H)
+            if model.n_iter_ < segment:
+                break  # Converged within the segment
+    return W, H, history
+
+def project(X, H, max_iter):
+    """Solve for the topic weights of the rows of X with the topics H held fixed."""
+    W, _, _ = non_negative_factorization(
+        X, H=np.array(H, dtype=X.dtype), n_components=H.shape[0], update_H=False, max_iter=max_iter
+    )
+    return W
+
+def fit_online(X, n_topics, rows, batch_size, epochs, previous=None):
+    """
+    Mini-batch NMF: update H from the given rows in batches of batch_size, starting
+    from the previous topics when given. Time and reconstruction error of those rows
+    are logged after every epoch. Afterwards every row, old ones included, is
+    projected onto the updated topics, so all of W is in the same topic basis and
+    cosine scores between old and new perfumes stay comparable.
+    """
+    history = []
+    start = time.perf_counter()
+    model = MiniBatchNMF(n_components=n_topics, batch_size=batch_size, random_state=42,
+                         init='custom' if previous is not None else None)
+    rng = np.random.default_rng(42)
+    X_rows = X[rows]
+    order = np.arange(len(rows))
+    initialized = False
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        for epoch in range(1, epochs + 1):
+            for batch_start in range(0, len(rows), batch_size):
+                batch = X_rows[order[batch_start:batch_start + batch_size]]
+                if not initialized and previous is not None:
+                    # Seed the model with the previous topics
+                    H = np.array(previous['H'], dtype=X.dtype)
+                    model.partial_fit(batch, W=project(batch, H, 200), H=H)
+                else:
+                    model.partial_fit(batch)
+                initialized = True
+            W_rows = model.transform(X_rows)
+            log_iteration(history, epoch, start, X_rows, W_rows, model.components_)
+            order = rng.permutation(len(rows))
+
+    H = model.components_
+    if len(rows) == X.shape[0] and np.array_equal(rows, np.arange(X.shape[0])):
+        return W_rows, H, history  # Every row was just transformed with the final topics
+    # The previous weights of the other rows belong to the old topics; H is fixed here,
+    # so re-projecting all rows is cheap next to the mini-batch updates
+    W = project(X, H, 200)
+    history.append([epochs, time.perf_counter() - start, reconstruction_error(X, W, H)])
+    print(f"  all {X.shape[0]} rows re-projected: {history[-1][1]:8.2f}s, reconstruction error {history[-1][2]:.6f}")
+    return W, H, history
+
+def perform_nmf(tfidf_matrix_file, n_topics, output_nmf_file, mode='full', previous_nmf_file=None,
+                max_iter=200, tol=1e-4, batch_size=1024, epochs=5, dtype='float64', log_every=0):
+    """
+    Factorize the TF-IDF matrix into W (perfume-topic) and H (topic-term).
+
+    mode is one of
+      full:      cold fit of all rows (the original behaviour)
+      warm:      fit of all rows starting from the previous H (and W for known rows)
+      online:    mini-batch updates of H from new and changed rows only (all rows,
+                 from scratch, without a previous run)
+      transform: project new and changed rows onto the previous, unchanged H
+    warm and transform need previous_nmf_file, the output folder of an earlier run.
+    The fit runs in the precision of the TF-IDF matrix; W and H are saved as dtype
+    ('float32' halves their size).
+    """
     # Step 1: Load the TF-IDF matrix
-    with open(tfidf_matrix_file, 'rb') as f:
-        tfidf_matrix = pickle.load(f)
-    
+    tfidf_matrix = load_sparse_matrix(tfidf_matrix_file)
+    row_hashes, idf_hash = tfidf_state(tfidf_matrix_file)
+
+    previous, previous_meta = None, {}
+    if mode in ('warm', 'transform') and (previous_nmf_file is None or not os.path.exists(previous_nmf_file)):
+        raise ValueError(f"--mode {mode} needs --previous_nmf_file pointing to an earlier NMF output.")
+    if mode != 'full' and previous_nmf_file is not None:
+        previous, previous_meta = load_arrays(previous_nmf_file)
+        if previous['H'].shape[1] != tfidf_matrix.shape[1]:
+            raise ValueError("The TF-IDF vocabulary changed since the previous factorization; run --mode full.")
+        n_topics = previous['H'].shape[0]
+
     # Step 2: Apply NMF for dimensionality reduction
-    print(f"Applying NMF with {n_topics} topics...")
-    nmf_model = NMF(n_components=n_topics, random_state=42)
-    W = nmf_model.fit_transform(tfidf_matrix)  # Document-topic matrix
-    H = nmf_model.components_                  # Topic-term matrix
-    
-    # Step 3: Save the NMF model and matrices
-    with open(output_nmf_file, 'wb') as f:
-        pickle.dump({'nmf_model': nmf_model, 'W': W, 'H': H}, f)
+    print(f"Applying NMF ({mode}) with {n_topics} topics...")
+    start = time.perf_counter()
+    if mode == 'full':
+        W, H, history = fit_nmf(tfidf_matrix, n_topics, max_iter, tol, log_every=log_every)
+    elif previous is None:
+        W, H, history = fit_online(tfidf_matrix, n_topics, np.arange(tfidf_matrix.shape[0]), batch_size, epochs)
+    else:
+        rows = rows_to_refresh(tfidf_matrix.shape[0], row_hashes, idf_hash, previous, previous_meta)
+        print(f"{len(rows)} of {tfidf_matrix.shape[0]} rows are new or changed since the previous factorization.")
+        if mode == 'warm':
+            H = np.array(previous['H'], dtype=tfidf_matrix.dtype)
+            W = np.zeros((tfidf_matrix.shape[0], n_topics))
+            W[:previous['W'].shape[0]] = previous['W']
+            if len(rows):
+                W[rows] = project(tfidf_matrix[rows], H, max_iter)
+            W, H, history = fit_nmf(tfidf_matrix, n_topics, max_iter, tol, W, H, log_every)
+        elif mode == 'online':
+            if len(rows):
+                W, H, history = fit_online(tfidf_matrix, n_topics, rows, batch_size, epochs, previous)
+            else:
+                W, H, history = np.array(previous['W']), np.array(previous['H']), []
+        else:
+            H = np.array(previous['H'], dtype=tfidf_matrix.dtype)
+            W = np.zeros((tfidf_matrix.shape[0], n_topics))
+            W[:previous['W'].shape[0]] = previous['W']
+            if len(rows):
+                W[rows] = project(tfidf_matrix[rows], H, max_iter)
+            history = []
+            log_iteration(history, 0, start, tfidf_matrix, W, H)
+    print(f"NMF finished in {time.perf_counter() - start:.2f}s, "
+          f"reconstruction error {reconstruction_error(tfidf_matrix, W, H):.6f}")
+
+    # Step 3: Save the matrices as memory-mappable .npy arrays, with the settings and log
+    arrays = {'W': W.astype(dtype), 'H': H.astype(dtype)}
+    if row_hashes is not None:
+        arrays['row_hashes'] = row_hashes
+    save_arrays(output_nmf_file, arrays, {
+        'mode': mode,
+        'n_topics': n_topics,
+        'dtype': dtype,
+        'idf_hash': idf_hash,
+        'history': history,
+    })
     print(f"NMF model and matrices saved to {output_nmf_file}")
-    
+
+def matrix_hash(tfidf_matrix_file):
+    """Content hash of a TF-IDF matrix folder (its CSR arrays) or legacy pickle."""
+    if not os.path.isdir(tfidf_matrix_file):
+        return file_hash(tfidf_matrix_file)
+    digest = hashlib.sha256()
+    for name in ('data', 'indices', 'indptr'):
+        digest.update(file_hash(os.path.join(tfidf_matrix_file, f"{name}.npy")).encode())
+    return digest.hexdigest()
+
+def umass_coherence(X, H, top_n=10):
+    """
+    Mean UMass coherence of the topics: for the top_n terms of each topic, the average
+    of log((D(w_i, w_j) + 1) / D(w_j)) over term pairs, where D counts the perfumes
+    containing the terms. Closer to zero is more coherent.
+    """
+    scores = []
+    for topic in H:
+        top_terms = np.argsort(topic)[::-1][:top_n]
+        present = (X[:, top_terms] > 0).astype(np.float64)
+        co_occurrence = (present.T @ present).toarray()
+        doc_freq = np.maximum(np.diag(co_occurrence), 1)
+        i, j = np.triu_indices(len(top_terms), k=1)
+        scores.append(np.mean(np.log((co_occurrence[i, j] + 1) / doc_freq[i])))
+    return float(np.mean(scores))
+
+def fit_sweep_point(tfidf_matrix_file, n_topics, seed, max_iter, tol, cache_folder, threads):
+    """
+    Fit one topic count and cache W, H and its scores in cache_folder. Runs in a worker
+    process; the memory-mapped TF-IDF matrix is shared with the other workers through
+    the page cache.
+    """
+    tfidf_matrix = load_sparse_matrix(tfidf_matrix_file)
+    with threadpool_limits(threads), warnings.catch_warnings():
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        start = time.perf_counter()
+        model = NMF(n_components=n_topics, random_state=seed, max_iter=max_iter, tol=tol)
+        W = model.fit_transform(tfidf_matrix)
+        fit_time = time.perf_counter() - start
+        H = model.components_
+        result = {
+            'k': n_topics,
+            'seed': seed,
+            'fit_time': fit_time,
+            'n_iter': int(model.n_iter_),
+            'reconstruction_error': reconstruction_error(tfidf_matrix, W, H),
+            'coherence': umass_coherence(tfidf_matrix, H),
+        }
+    save_arrays(cache_folder, {'W': W, 'H': H}, {'max_iter': max_iter, 'tol': tol, 'result': result})
+    return result
+
+def sweep_topics(tfidf_matrix_file, topic_counts, sweep_dir, seed=42, max_iter=200, tol=1e-4, workers=None):
+    """
+    Fit every topic count in topic_counts, several at a time in worker processes, and
+    write a comparison table of fit time, reconstruction error and UMass coherence to
+    sweep_dir/sweep.csv. Each factorization is cached in sweep_dir under the matrix
+    hash, k and seed, so a rerun with more topic counts only fits the new ones. Every
+    cached folder is a regular NMF output that later stages can use directly.
+    """
+    workers = workers or os.cpu_count()
+    os.makedirs(sweep_dir, exist_ok=True)
+    tfidf_hash = matrix_hash(tfidf_matrix_file)[:16]
+
+    # Step 1: Reuse cached factorizations fitted with the same solver settings
+    results, pending = [], {}
+    for n_topics in sorted(set(topic_counts)):
+        cache_folder = os.path.join(sweep_dir, f"{tfidf_hash}_k{n_topics}_seed{seed}")
+        meta_path = os.path.join(cache_folder, 'meta.json')
+        if os.path.exists(meta_path):
+            _, meta = load_arrays(cache_folder)
+            if meta.get('max_iter') == max_iter and meta.get('tol') == tol:
+                results.append(dict(meta['result'], cached=True, folder=cache_folder))
+                continue
+        pending[n_topics] = cache_folder
+    print(f"{len(results)} topic counts cached, {len(pending)} to fit with {workers} workers.")
+
+    # Step 2: Fit the rest in parallel, largest k first so the slowest fits start early
+    threads = max(1, os.cpu_count() // workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fit_sweep_point, tfidf_matrix_file, n_topics, seed, max_iter, tol, cache_folder, threads): cache_folder
+            for n_topics, cache_folder in sorted(pending.items(), reverse=True)
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"  k={result['k']}: {result['fit_time']:.2f}s, error {result['reconstruction_error']:.4f}, "
+                  f"coherence {result['coherence']:.4f}")
+            results.append(dict(result, cached=False, folder=futures[future]))
+
+    # Step 3: Write the comparison table
+    table = pd.DataFrame(results).sort_values('k').reset_index(drop=True)
+    table_path = os.path.join(sweep_dir, 'sweep.csv')
+    write_table(table, table_path)
+    print(table.drop(columns='folder').to_string(index=False))
+    print(f"Sweep table saved to {table_path}")
+    return table
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Perform NMF dimensionality reduction on TF-IDF matrix.')
-    parser.add_argument('--tfidf_matrix_file', type=str, required=True, help='Path to the TF-IDF matrix file (output from your TF-IDF script).')
+    parser.add_argument('--tfidf_matrix_file', type=str, required=True, help='Path to the TF-IDF matrix folder (output from your TF-IDF script).')
     parser.add_argument('--n_topics', type=int, default=10, help='Number of topics for NMF (default: 10).')
-    parser.add_argument('--output_nmf_file', type=str, default='nmf_model.pkl', help='Filename to save the NMF model and matrices (default: nmf_model.pkl).')
+    parser.add_argument('--output_nmf_file', type=str, default='nmf_model', help='Folder to save the NMF matrices in as .npy arrays (default: nmf_model).')
+    parser.add_argument('--mode', type=str, choices=['full', 'warm', 'online', 'transform'], default='full', help='full: cold fit; warm: refit starting from the previous H; online: mini-batch update from new and changed rows; transform: project new and changed rows onto the previous topics (default: full).')
+    parser.add_argument('--previous_nmf_file', type=str, default=None, help='Folder of an earlier NMF run, required by the warm and transform modes and used by online mode when given.')
+    parser.add_argument('--max_iter', type=int, default=200, help='Maximum solver iterations (default: 200).')
+    parser.add_argument('--tol', type=float, default=1e-4, help='Tolerance of the solver\'s stopping condition (default: 1e-4).')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Rows per mini-batch in online mode (default: 1024).')
+    parser.add_argument('--epochs', type=int, default=5, help='Passes over the updated rows in online mode (default: 5).')
+    parser.add_argument('--sweep', type=int, nargs='+', default=None, help='Fit each of these topic counts instead of a single model, and compare them.')
+    parser.add_argument('--sweep_dir', type=str, default='nmf_sweep', help='Folder caching the sweep factorizations and its table (default: nmf_sweep).')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed of the sweep fits (default: 42).')
+    parser.add_argument('--workers', type=int, default=None, help='Topic counts fitted at a time in a sweep (default: number of CPUs).')
+    parser.add_argument('--dtype', type=str, choices=['float64', 'float32'], default='float64', help='Precision W and H are saved in; float32 halves their size (default: float64).')
+    parser.add_argument('--log_every', type=int, default=0, help='Log the reconstruction error every this many iterations in full and warm modes; runs the solver in segments, so it is slower and can end slightly differently (default: 0, only the final error).')
     args = parser.parse_args()
-    
-    perform_nmf(args.tfidf_matrix_file, args.n_topics, args.output_nmf_file)
\ No newline at end of file
+
+    if args.sweep:
+        sweep_topics(args.tfidf_matrix_file, args.sweep, args.sweep_dir, args.seed, args.max_iter, args.tol, args.workers)
+        raise SystemExit(0)
+    perform_nmf(args.tfidf_matrix_file, args.n_topics, args.output_nmf_file, args.mode, args.previous_nmf_file,
+                args.max_iter, args.tol, args.batch_size, args.epochs, args.dtype, args.log_every)
@@ -0,0 +1,274 @@
+import os
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+import yt_dlp
+from tt_download import build_ydl_options, download_video
+from tt_transcribe import SpeechConverter, get_whisper_model
+from tt_OCR import extract_frames_and_text
+from tt_combine import combine_transcription_and_ocr
+from tt_chatgpt_NER import extract_entities_and_phrases, ResponseCache
+from tt_data_preprocess import preprocess
+from tt_manifest import atomic_write
+
+# Marker sent downstream once a stage has no more items to produce
+STOP = object()
+
+class PipelineStage:
+    """
+    A pool of worker threads that take items from in_queue, apply func and put
+    every non-None result on each of the out_queues.
+
+    A stage may be fed by several upstream stages (producers); it finishes once
+    all of them have sent STOP, and then sends a single STOP to each out_queue.
+    """
+    def __init__(self, name, func, in_queue, out_queues, workers=1, producers=1):
+        self.name = name
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queues = out_queues
+        self.producers = producers
+        self.lock = threading.Lock()
+        self.stops_seen = 0
+        self.upstream_done = False
+        self.running_workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.first_output_time = None
+        self.threads = [
+            threading.Thread(target=self.run_worker, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def run_worker(self):
+        while True:
+            item = self.in_queue.get()
+            if item is STOP:
+                with self.lock:
+                    if not self.upstream_done:
+                        self.stops_seen += 1
+                        self.upstream_done = self.stops_seen == self.producers
+                    done = self.upstream_done
+                if done:
+                    # Pass the marker on so sibling workers stop as well
+                    self.in_queue.put(STOP)
+                    break
+                continue
+
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                print(f"[{self.name}] Error processing {item}: {e}")
+                result = None
+                with self.lock:
+                    self.failed += 1
+            else:
+                with self.lock:
+                    self.processed += 1
+            with self.lock:
+                self.busy_time += time.perf_counter() - start
+
+            if result is not None:
+                with self.lock:
+                    if self.first_output_time is None:
+                        self.first_output_time = time.perf_counter()
+                for out_queue in self.out_queues:
+                    out_queue.put(result)
+
+        with self.lock:
+            self.running_workers -= 1
+            last_worker = self.running_workers == 0
+        if last_worker:
+            for out_queue in self.out_queues:
+                out_queue.put(STOP)
+
+def video_key(video_path):
+    """Identifier shared by all intermediate files of a video."""
+    return os.path.splitext(os.path.basename(video_path))[0]
+
+def run_pipeline(video_source, work_dir, output_file, from_urls=False, cookies=None, model_name='base',
+                 ocr_workers=2, ner_workers=4, queue_size=8, frame_interval=30, fps=None, cache=None):
+    """
+    Stream videos through download -> transcription and OCR (run side by side on each
+    video) -> combine -> NER -> preprocessing. Bounded queues connect the stages, so
+    the first preprocessed rows appear as soon as the first video makes it through,
+    not after each stage has finished the whole corpus.
+
+    video_source is either a text file of TikTok URLs (from_urls) or a folder of mp4
+    files. Intermediate results are kept in the same per-stage folders the individual
+    scripts write, under work_dir.
+    """
+    folders = {name: os.path.join(work_dir, name) for name in ("videos", "transcriptions", "ocr", "combined", "ner")}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    source_queue = queue.Queue()
+    transcribe_queue = queue.Queue(maxsize=queue_size)
+    ocr_queue = queue.Queue(maxsize=queue_size)
+    join_queue = queue.Queue(maxsize=queue_size)
+    ner_queue = queue.Queue(maxsize=queue_size)
+    preprocess_queue = queue.Queue(maxsize=queue_size)
+
+    # Stage 1: download (or list) the videos
+    if from_urls:
+        with open(video_source, 'r') as f:
+            items = [line.strip() for line in f if line.strip()]
+        ydl = yt_dlp.YoutubeDL(build_ydl_options(folders["videos"], cookies))
+
+        def download(url):
+            video_path = download_video(ydl, url)
+            if video_path and not video_path.endswith(".mp4"):
+                print(f"[download] Skipping {video_path}: not an mp4 file.")
+                return None
+            return video_path
+    else:
+        items = sorted(
+            os.path.join(video_source, file_name)
+            for file_name in os.listdir(video_source) if file_name.endswith(".mp4")
+        )
+        download = None
+
+    # Stage 2a: transcription; a single worker owns the Whisper model
+    get_whisper_model(model_name)
+
+    def transcribe(video_path):
+        speech_converter = SpeechConverter(
+            video_path, folders["transcriptions"], model_name=model_name, stream_audio=True
+        )
+        # A failed transcription (returned as None) still lets the OCR text through
+        return video_path, "transcription", speech_converter.extract_and_transform_speech() or ""
+
+    # Stage 2b: OCR, several videos at a time
+    def ocr(video_path):
+        output_text_file = os.path.join(folders["ocr"], f"{video_key(video_path)}_text.txt")
+        try:
+            extract_frames_and_text(video_path, output_text_file, frame_interval, fps)
+            with open(output_text_file, 'r') as f:
+                return video_path, "ocr", f.read()
+        except Exception as e:
+            # Still hand the video on, so its transcription is not held back forever
+            print(f"[ocr] Error processing {video_path}: {e}")
+            return video_path, "ocr", ""
+
+    # Stage 3: wait for both halves of a video, then combine them
+    partial_results = {}
+
+    def combine(item):
+        video_path, kind, text = item
+        parts = partial_results.setdefault(video_path, {})
+        parts[kind] = text
+        if len(parts) < 2:
+            return None
+        del partial_results[video_path]
+        combined_data = combine_transcription_and_ocr({"text": parts["transcription"]}, parts["ocr"])
+        with atomic_write(os.path.join(folders["combined"], f"{video_key(video_path)}.json")) as f:
+            json.dump(combined_data, f, indent=4)
+        return video_path, combined_data["combined_text"]
+
+    # Stage 4: NER
+    def ner(item):
+        video_path, combined_text = item
+        result = extract_entities_and_phrases(combined_text, cache)
+        if not result:
+            return None
+        with atomic_write(os.path.join(folders["ner"], f"{video_key(video_path)}.json")) as f:
+            f.write(result)
+        return json.loads(result)["data"]
+
+    # Stage 5: preprocess descriptors and append rows to the output CSV
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    csv_file = open(output_file, 'w', newline='')
+    writer = csv.DictWriter(csv_file, fieldnames=["brand", "perfume_name", "descriptors"], extrasaction='ignore')
+    writer.writeheader()
+
+    def preprocess_rows(rows):
+        for row in rows:
+            row["descriptors"] = preprocess(row.get("descriptors", ""))
+            writer.writerow(row)
+        csv_file.flush()
+        return len(rows)
+
+    fan_out = [transcribe_queue, ocr_queue]
+    stages = []
+    if download is not None:
+        stages.append(PipelineStage("download", download, source_queue, fan_out))
+    else:
+        source_queue = None
+    stages += [
+        PipelineStage("transcribe", transcribe, transcribe_queue, [join_queue]),
+        PipelineStage("ocr", ocr, ocr_queue, [join_queue], workers=ocr_workers),
+        PipelineStage("combine", combine, join_queue, [ner_queue], producers=2),
+        PipelineStage("ner", ner, ner_queue, [preprocess_queue], workers=ner_workers),
+        PipelineStage("preprocess", preprocess_rows, preprocess_queue, []),
+    ]
+
+    start = time.perf_counter()
+    for stage in stages:
+        stage.start()
+
+    # Feed the first stage; the bounded queues throttle this loop
+    if source_queue is not None:
+        for item in items:
+            source_queue.put(item)
+        source_queue.put(STOP)
+    else:
+        for item in items:
+            for out_queue in fan_out:
+                out_queue.put(item)
+        for out_queue in fan_out:
+            out_queue.put(STOP)
+
+    for stage in stages:
+        stage.join()
+    csv_file.close()
+    if partial_results:
+        print(f"{len(partial_results)} videos were only partly processed and did not reach NER.")
+    elapsed = time.perf_counter() - start
+
+    print(f"Pipeline finished in {elapsed:.1f}s for {len(items)} inputs. Preprocessed data saved to {output_file}")
+    for stage in stages:
+        first_output = f"{stage.first_output_time - start:.1f}s" if stage.first_output_time else "n/a"
+        print(f"  {stage.name:<11} {stage.processed} ok, {stage.failed} failed, busy {stage.busy_time:.1f}s, "
+              f"first output after {first_output}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the download, transcription, OCR, combine, NER and preprocessing steps as one streaming pipeline")
+    parser.add_argument("source", type=str, help="Folder of mp4 files, or a text file of TikTok URLs with --urls.")
+    parser.add_argument("work_dir", type=str, help="Folder for intermediate results (videos, transcriptions, ocr, combined, ner).")
+    parser.add_argument("--urls", action="store_true", help="Treat source as a text file of TikTok URLs to download.")
+    parser.add_argument("--cookies", type=str, default=None, help="Path to cookies.txt file for downloading (optional).")
+    parser.add_argument("--output_file", type=str, default="data/preprocessed_descriptors.csv", help="Path for the preprocessed CSV (default: data/preprocessed_descriptors.csv).")
+    parser.add_argument("--model", type=str, default="base", help="Whisper model size to use (default: base).")
+    parser.add_argument("--ocr_workers", type=int, default=2, help="Number of videos OCRed at a time (default: 2).")
+    parser.add_argument("--ner_workers", type=int, default=4, help="Number of concurrent NER requests (default: 4).")
+    parser.add_argument("--queue_size", type=int, default=8, help="Maximum number of items waiting between two stages (default: 8).")
+    parser.add_argument("--frame_interval", type=int, default=30, help="Interval of frames to OCR (default is every 30th frame).")
+    parser.add_argument("--fps", type=float, default=None, help="Frames to OCR per second of video; overrides --frame_interval when set.")
+    parser.add_argument("--cache_file", type=str, default="data/ner_cache.sqlite", help="SQLite file caching NER responses (default: data/ner_cache.sqlite).")
+    parser.add_argument("--no_cache", action="store_true", help="Always call the NER API, bypassing the response cache.")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else ResponseCache(args.cache_file)
+    run_pipeline(args.source, args.work_dir, args.output_file, args.urls, args.cookies, args.model,
+                 args.ocr_workers, args.ner_workers, args.queue_size, args.frame_interval, args.fps, cache)
+    if cache is not None:
+        cache.report()
+        cache.close()
+
+if __name__ == "__main__":
+    main()
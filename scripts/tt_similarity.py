@@ -0,0 +1,249 @@
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+from tt_io import read_table, load_arrays, save_arrays
+
+def normalize_rows(W):
+    """
+    Return W with every row scaled to unit length; all-zero rows stay zero. float32
+    input stays float32, anything else becomes float64.
+    """
+    W = np.asarray(W)
+    W = W.astype(np.float32 if W.dtype == np.float32 else np.float64, copy=False)
+    norms = np.linalg.norm(W, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return W / norms
+
+def sparsify_rows(W_normalized, epsilon):
+    """
+    Zero the entries of unit-length rows below epsilon, rescale the rows to unit length
+    again and return them as a CSR matrix. NMF topic weights concentrate on a few topics,
+    so most entries are near zero and dropping them barely moves the similarities.
+    """
+    import scipy.sparse as sp
+    return sp.csr_matrix(normalize_rows(np.where(np.abs(W_normalized) < epsilon, 0, W_normalized)))
+
+def compact_rows(W_normalized, epsilon):
+    """
+    Sparsify unit-length rows under epsilon (see sparsify_rows) and return the CSR matrix
+    if it takes at most half the memory of the dense rows, else the thresholded rows as
+    a dense array. Products with the sparse matrix are slower than dense ones, and CSR
+    stores a column index next to every value, so the sparse form is only worth it when
+    most weights were dropped (below about a quarter density in float32).
+    """
+    W_sparse = sparsify_rows(W_normalized, epsilon)
+    sparse_bytes = W_sparse.data.nbytes + W_sparse.indices.nbytes + W_sparse.indptr.nbytes
+    if 2 * sparse_bytes <= W_sparse.shape[0] * W_sparse.shape[1] * W_sparse.dtype.itemsize:
+        return W_sparse
+    return W_sparse.toarray()
+
+def top_k_of_block(similarities, start, k):
+    """
+    Indices and scores of the k largest similarities of each row of a block, best first.
+    Row r of the block is perfume start + r, which is excluded from its own neighbors.
+    """
+    rows = np.arange(similarities.shape[0])
+    similarities[rows, start + rows] = -np.inf
+    candidates = np.argpartition(similarities, -k, axis=1)[:, -k:]
+    candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+def top_k_neighbors(W, k, block_size=512, workers=1, bin_edges=None, epsilon=0.0):
+    """
+    Find the k most cosine-similar perfumes of every perfume without building the N x N
+    similarity matrix.
+
+    W is normalized once; then blocks of block_size rows are multiplied against all of
+    it and only the k best neighbors of each row are kept (argpartition, then a sort of
+    those k). Blocks run in `workers` threads, which share W; numpy releases the GIL in
+    the matrix products. Each block holds block_size x N scores in the precision of W
+    (float32 or float64), so memory is about itemsize * block_size * N * workers bytes.
+
+    With epsilon > 0, normalized weights below epsilon are dropped (see sparsify_rows),
+    and W is kept as a sparse matrix that each block is multiplied against when that
+    saves memory (see compact_rows). This shrinks W only; it does not speed up the
+    search, which is dominated by the dense score blocks.
+
+    Returns (indices, scores, counts): N x k arrays of neighbor indices and cosine
+    similarities, best first, and, if bin_edges is given, a histogram of all
+    pairwise similarities (upper triangle, as np.histogram counts), else None.
+    """
+    W_normalized = normalize_rows(W)
+    if epsilon > 0:
+        W_normalized = compact_rows(W_normalized, epsilon)
+    is_sparse = not isinstance(W_normalized, np.ndarray)
+    n_rows = W_normalized.shape[0]
+    k = min(k, n_rows - 1)
+    indices = np.empty((n_rows, k), dtype=np.int64)
+    scores = np.empty((n_rows, k), dtype=W_normalized.dtype)
+
+    def process_block(start):
+        stop = min(start + block_size, n_rows)
+        block = W_normalized[start:stop]
+        if is_sparse:
+            # A dense block times the sparse W gives the dense scores directly; a
+            # sparse-sparse product would build them entry by entry, several times slower
+            block = block.toarray()
+        similarities = np.asarray(block @ W_normalized.T)
+        counts = None
+        if bin_edges is not None:
+            # Each pair once: only the columns after the row's own perfume
+            upper = np.arange(n_rows)[None, :] > np.arange(start, stop)[:, None]
+            # (clipped, so rounding just past 1.0 still lands in the last bin)
+            counts, _ = np.histogram(np.clip(similarities[upper], bin_edges[0], bin_edges[-1]), bins=bin_edges)
+        indices[start:stop], scores[start:stop] = top_k_of_block(similarities, start, k)
+        return counts
+
+    starts = range(0, n_rows, block_size)
+    if workers > 1:
+        # One BLAS thread per block, so the blocks rather than the products run in parallel
+        with threadpool_limits(1), ThreadPoolExecutor(max_workers=workers) as executor:
+            block_counts = list(executor.map(process_block, starts))
+    else:
+        block_counts = [process_block(start) for start in starts]
+
+    counts = np.sum(block_counts, axis=0) if bin_edges is not None else None
+    return indices, scores, counts
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbor index over topic vectors (an inverted file index).
+
+    The normalized vectors are clustered with k-means into n_lists lists, stored
+    contiguously list by list. A query is compared with the list centroids and only
+    the vectors of its n_probe closest lists are scored exactly, so a query costs
+    about n_probe / n_lists of a full scan. Perfumes are identified by the `index`
+    column of the perfume mapping rather than by their row in W.
+    """
+    def __init__(self, centroids, vectors, ids, list_offsets):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.list_offsets = list_offsets
+        # Lookup from perfume index to position in the lists
+        self.id_order = np.argsort(ids, kind='stable')
+        self.sorted_ids = np.asarray(ids)[self.id_order]
+
+    @classmethod
+    def build(cls, W, ids=None, n_lists=None, seed=42):
+        """Cluster W into n_lists lists (default: about 4 * sqrt(N)) and build the index."""
+        from sklearn.cluster import MiniBatchKMeans
+        vectors = normalize_rows(W)
+        ids = np.arange(len(vectors)) if ids is None else np.asarray(ids, dtype=np.int64)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3, batch_size=4096)
+        labels = kmeans.fit_predict(vectors)
+        order = np.argsort(labels, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+        return cls(normalize_rows(kmeans.cluster_centers_), vectors[order], ids[order], list_offsets)
+
+    def save(self, path):
+        save_arrays(path, {
+            'centroids': self.centroids,
+            'vectors': self.vectors,
+            'ids': self.ids,
+            'list_offsets': self.list_offsets,
+        }, {'kind': 'ivf', 'n_lists': len(self.centroids)})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, _ = load_arrays(path, mmap)
+        return cls(np.asarray(arrays['centroids']), arrays['vectors'], np.asarray(arrays['ids']),
+                   np.asarray(arrays['list_offsets']))
+
+    def positions_of(self, ids):
+        """Positions in the lists of the given perfume indices (KeyError for unknown ones)."""
+        ids = np.asarray(ids)
+        found = np.searchsorted(self.sorted_ids, ids)
+        found = np.minimum(found, len(self.sorted_ids) - 1)
+        if not np.all(self.sorted_ids[found] == ids):
+            raise KeyError(f"Unknown perfume index in {ids[self.sorted_ids[found] != ids].tolist()}")
+        return self.id_order[found]
+
+    def query(self, vectors, k=10, n_probe=8, exclude_ids=None):
+        """
+        Return (ids, scores) of the k approximate nearest perfumes of each query vector,
+        best first. exclude_ids gives one perfume index per query to leave out (itself).
+        Rows are padded with -1 / -inf when the probed lists hold fewer than k perfumes.
+        """
+        queries = normalize_rows(np.atleast_2d(vectors))
+        n_probe = min(n_probe, len(self.centroids))
+        probed = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        result_scores = np.full((len(queries), k), -np.inf)
+        for q, lists in enumerate(probed):
+            candidates = np.concatenate([
+                np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in lists
+            ])
+            if exclude_ids is not None:
+                candidates = candidates[self.ids[candidates] != exclude_ids[q]]
+            scores = self.vectors[candidates] @ queries[q]
+            top = min(k, len(candidates))
+            if top == 0:
+                continue
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            result_ids[q, :top] = self.ids[candidates[best]]
+            result_scores[q, :top] = scores[best]
+        return result_ids, result_scores
+
+    def query_ids(self, ids, k=10, n_probe=8):
+        """Neighbors of perfumes already in the index, by their mapping index, excluding themselves."""
+        ids = np.atleast_1d(ids)
+        return self.query(self.vectors[self.positions_of(ids)], k, n_probe, exclude_ids=ids)
+
+def perfume_ids(perfume_mapping, brand, perfume_name):
+    """Mapping index of a perfume, matched case-insensitively on brand and name."""
+    matches = perfume_mapping[
+        (perfume_mapping['brand'].astype(str).str.lower() == brand.lower())
+        & (perfume_mapping['perfume_name'].astype(str).str.lower() == perfume_name.lower())
+    ]
+    if matches.empty:
+        raise KeyError(f"No perfume '{perfume_name}' by '{brand}' in the mapping.")
+    return int(matches['index'].iloc[0])
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query an approximate nearest-neighbor index over NMF topic vectors")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the index from the NMF output.")
+    build_parser.add_argument("--nmf_file", type=str, required=True, help="Path to the NMF matrices folder.")
+    build_parser.add_argument("--perfume_mapping_file", type=str, required=True, help="Path to the perfume mapping file.")
+    build_parser.add_argument("--index_dir", type=str, default="data/ann_index", help="Folder to save the index in (default: data/ann_index).")
+    build_parser.add_argument("--n_lists", type=int, default=None, help="Number of k-means lists (default: about 4 * sqrt(number of perfumes)).")
+    build_parser.add_argument("--seed", type=int, default=42, help="Random seed of the k-means clustering (default: 42).")
+
+    query_parser = subparsers.add_parser("query", help="Print the perfumes most similar to one perfume.")
+    query_parser.add_argument("brand", type=str, help="Brand of the perfume.")
+    query_parser.add_argument("perfume_name", type=str, help="Name of the perfume.")
+    query_parser.add_argument("--perfume_mapping_file", type=str, required=True, help="Path to the perfume mapping file.")
+    query_parser.add_argument("--index_dir", type=str, default="data/ann_index", help="Folder of the index (default: data/ann_index).")
+    query_parser.add_argument("--k", type=int, default=10, help="Number of similar perfumes (default: 10).")
+    query_parser.add_argument("--n_probe", type=int, default=8, help="Lists scanned per query; more is slower and more exact (default: 8).")
+    args = parser.parse_args()
+
+    perfume_mapping = read_table(args.perfume_mapping_file)
+    if args.command == "build":
+        nmf_arrays, _ = load_arrays(args.nmf_file)
+        start = time.perf_counter()
+        index = IVFIndex.build(nmf_arrays['W'], perfume_mapping['index'].to_numpy(), args.n_lists, args.seed)
+        index.save(args.index_dir)
+        print(f"Index over {len(index.ids)} perfumes with {len(index.centroids)} lists built in "
+              f"{time.perf_counter() - start:.2f}s and saved to {args.index_dir}")
+    else:
+        index = IVFIndex.load(args.index_dir)
+        start = time.perf_counter()
+        ids, scores = index.query_ids(perfume_ids(perfume_mapping, args.brand, args.perfume_name), args.k, args.n_probe)
+        elapsed = time.perf_counter() - start
+        labels = perfume_mapping.set_index('index')
+        for perfume_id, score in zip(ids[0], scores[0]):
+            if perfume_id >= 0:
+                print(f"{score:.3f}  {labels.at[perfume_id, 'brand']} - {labels.at[perfume_id, 'perfume_name']}")
+        print(f"Query answered in {elapsed * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,102 @@
+import os
 import pandas as pd
 import numpy as np
-import pickle
 from sklearn.metrics.pairwise import cosine_similarity
 import networkx as nx
-import matplotlib.pyplot as plt
 import argparse
+from tt_io import read_table, load_arrays, write_table
+from tt_similarity import top_k_neighbors
 
-def build_similarity_network(perfume_mapping_file, nmf_file, threshold):
+def edge_arrays(top_indices, top_scores, threshold):
+    """
+    Turn the top neighbors of every perfume into undirected edges as numpy arrays
+    (sources, targets, weights), keeping scores >= threshold. A pair found from both
+    ends is kept once, with source < target.
+    """
+    n_rows, k = top_indices.shape
+    sources = np.repeat(np.arange(n_rows), k)
+    targets = top_indices.ravel()
+    weights = top_scores.ravel()
+    keep = weights >= threshold
+    sources, targets, weights = sources[keep], targets[keep], weights[keep]
+    pairs = np.stack([np.minimum(sources, targets), np.maximum(sources, targets)], axis=1)
+    pairs, first = np.unique(pairs, axis=0, return_index=True)
+    return pairs[:, 0], pairs[:, 1], weights[first]
+
+def write_edge_list(path, sources, targets, weights, n_nodes):
+    """
+    Write the edges as a table (source, target, weight; CSV, Parquet or Feather by
+    extension) or, for a .npz path, as an upper-triangular CSR matrix with scipy.
+    """
+    if path.endswith('.npz'):
+        import scipy.sparse as sp
+        sp.save_npz(path, sp.csr_matrix((weights, (sources, targets)), shape=(n_nodes, n_nodes)))
+    else:
+        write_table(pd.DataFrame({'source': sources, 'target': targets, 'weight': weights}), path)
+
+def build_similarity_network(perfume_mapping_file, nmf_file, threshold, block_size=512, workers=1, top_n=5,
+                             output_gexf='data/perfume_similarity_network.gexf', output_edges=None, headless=False,
+                             dtype=None, epsilon=0.0):
     # Step 1: Load the perfume mapping
-    perfume_mapping = pd.read_csv(perfume_mapping_file)
+    perfume_mapping = read_table(perfume_mapping_file)
     
     # Ensure the necessary columns are present
     if not {'index', 'brand', 'perfume_name'}.issubset(perfume_mapping.columns):
-        raise ValueError("Perfume mapping CSV must contain 'index', 'brand', and 'perfume_name' columns.")
+        raise ValueError("Perfume mapping must contain 'index', 'brand', and 'perfume_name' columns.")
     
     # Create a unique identifier for each perfume
-    perfume_mapping['unique_label'] = perfume_mapping['brand'] + ' - ' + perfume_mapping['perfume_name']
+    # (astype(str) since categorical columns from Parquet/Feather do not support +)
+    perfume_mapping['unique_label'] = perfume_mapping['brand'].astype(str) + ' - ' + perfume_mapping['perfume_name'].astype(str)
     
-    # Step 2: Load the NMF model and matrices
-    with open(nmf_file, 'rb') as f:
-        nmf_data = pickle.load(f)
-    W = nmf_data['W']  # Document-topic matrix
+    # Step 2: Load the NMF matrices (memory-mapped, not deserialized)
+    nmf_arrays, _ = load_arrays(nmf_file)
+    W = nmf_arrays['W']  # Document-topic matrix
+    if dtype is not None:
+        W = W.astype(dtype)
     
-    # Step 3: Compute pairwise cosine similarity
-    print("Computing pairwise cosine similarity...")
-    similarity_matrix = cosine_similarity(W)
-
-    sim_scores = similarity_matrix[np.triu_indices(similarity_matrix.shape[0], k=1)]
+    # Step 3: Find the top N neighbors of every perfume, block by block, without the
+    # full similarity matrix; the score histogram is accumulated along the way, unless
+    # headless, where it would never be drawn
+    print("Computing top cosine similarities...")
+    bin_edges = None
+    if not headless:
+        bin_edges = np.linspace(0, 1, 51) if np.min(W) >= 0 else np.linspace(-1, 1, 51)
+    top_indices, top_scores, counts = top_k_neighbors(W, top_n, block_size, workers, bin_edges, epsilon)
 
-    plt.hist(sim_scores, bins=50)
-    plt.xlabel('Similarity Score')
-    plt.ylabel('Frequency')
-    plt.title('Distribution of Similarity Scores')
-    plt.show()
+    if not headless:
+        import matplotlib.pyplot as plt
+        plt.stairs(counts, bin_edges, fill=True)
+        plt.xlabel('Similarity Score')
+        plt.ylabel('Frequency')
+        plt.title('Distribution of Similarity Scores')
+        plt.show()
     
-    # Step 4: Build the similarity network
+    # Step 4: Build the similarity network from edge arrays, in bulk
     print("Building the similarity network...")
-    N = 5  # Number of top edges to keep per node
+    sources, targets, weights = edge_arrays(top_indices, top_scores, threshold)
 
     G = nx.Graph()
-    # Add nodes with attributes
-    for idx, row in perfume_mapping.iterrows():
-        G.add_node(idx, perfume_name=row['unique_label'], brand=row['brand'])
+    G.add_nodes_from(
+        (i, {'perfume_name': label, 'brand': brand})
+        for i, (label, brand) in enumerate(zip(perfume_mapping['unique_label'], perfume_mapping['brand'].astype(str)))
+    )
+    G.add_edges_from(zip(sources.tolist(), targets.tolist(), ({'weight': weight} for weight in weights.tolist())))
+    print(f"{G.number_of_nodes()} perfumes, {G.number_of_edges()} edges")
 
-    # Add top N edges per node
-    num_perfumes = similarity_matrix.shape[0]
-    for i in range(num_perfumes):
-        similarities = similarity_matrix[i]
-        # Get indices of the top N similar perfumes, excluding itself
-        top_indices = similarities.argsort()[-(N+1):-1]  # Exclude the last one (itself)
-        for j in top_indices:
-            if i != j and similarities[j] >= threshold:
-                G.add_edge(i, j, weight=similarities[j])
-    
-    nx.write_gexf(G, 'data/perfume_similarity_network.gexf')
-    print('Graph exported to data/perfume_similarity_network.gexf')
+    for path in (output_gexf, output_edges):
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    nx.write_gexf(G, output_gexf)
+    print(f'Graph exported to {output_gexf}')
+    if output_edges:
+        write_edge_list(output_edges, sources, targets, weights, len(perfume_mapping))
+        print(f'Edge list exported to {output_edges}')
+
+    if headless:
+        return
 
     print("Similarity Matrix Sample:")
-    print(similarity_matrix[:5, :5])  # Print a small sample
+    print(cosine_similarity(W[:5]))  # Print a small sample
 
     # Step 5: Visualize the network
     print("Visualizing the network...")
@@ -85,9 +124,18 @@ def build_similarity_network(perfume_mapping_file, nmf_file, threshold):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Build and visualize a perfume similarity network based on NMF results.')
-    parser.add_argument('--perfume_mapping_file', type=str, required=True, help='Path to the perfume mapping CSV file.')
-    parser.add_argument('--nmf_file', type=str, required=True, help='Path to the NMF model and matrices file (output from the NMF script).')
+    parser.add_argument('--perfume_mapping_file', type=str, required=True, help='Path to the perfume mapping file (CSV, .parquet or .feather).')
+    parser.add_argument('--nmf_file', type=str, required=True, help='Path to the NMF matrices folder (output from the NMF script).')
     parser.add_argument('--threshold', type=float, default=0.5, help='Similarity threshold for connecting perfumes (default: 0.5).')
+    parser.add_argument('--block_size', type=int, default=512, help='Perfumes whose similarities are computed at a time; each block takes 8 (float32: 4) x block_size x N bytes (default: 512).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of blocks processed in parallel (default: 1).')
+    parser.add_argument('--top_n', type=int, default=5, help='Number of most similar perfumes linked to each perfume (default: 5).')
+    parser.add_argument('--output_gexf', type=str, default='data/perfume_similarity_network.gexf', help='Path of the GEXF graph (default: data/perfume_similarity_network.gexf).')
+    parser.add_argument('--output_edges', type=str, default=None, help='Also write the edges as a table (.csv, .parquet, .feather) or a CSR matrix (.npz) (optional).')
+    parser.add_argument('--headless', action='store_true', help='Only build and export the graph: no histogram, layout or drawing.')
+    parser.add_argument('--dtype', type=str, choices=['float64', 'float32'], default=None, help='Precision of the similarity computation (default: that of the saved W).')
+    parser.add_argument('--epsilon', type=float, default=0.0, help='Drop normalized topic weights below this and use sparse products (default: 0, dense).')
     args = parser.parse_args()
     
-    build_similarity_network(args.perfume_mapping_file, args.nmf_file, args.threshold)
\ No newline at end of file
+    build_similarity_network(args.perfume_mapping_file, args.nmf_file, args.threshold, args.block_size, args.workers,
+                             args.top_n, args.output_gexf, args.output_edges, args.headless, args.dtype, args.epsilon)
\ No newline at end of file
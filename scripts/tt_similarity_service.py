@@ -0,0 +1,353 @@
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tt_io import read_table, load_arrays
+from tt_similarity import IVFIndex, normalize_rows
+
+class QueryCache:
+    """Thread-safe LRU cache of query results."""
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+class PendingQuery:
+    """A query waiting for the batcher, and the slot its answer is put in."""
+    def __init__(self, kind, payload, k):
+        self.kind = kind
+        self.payload = payload
+        self.k = k
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SimilarityService:
+    """
+    Answers "top-k perfumes similar to this perfume" and "similar to this description"
+    from topic vectors loaded once.
+
+    Queries that miss the LRU cache go through a batcher thread, which collects the
+    queries arriving within batch_window seconds (up to max_batch) and answers them
+    together: descriptions are vectorized and projected onto the topics in one call,
+    and all query vectors are scored with one matrix product (or one index query).
+
+    Free-text queries need the TF-IDF vectorizer and the NMF topic matrix H; without
+    them only perfume queries are available. With an IVFIndex the search is
+    approximate; otherwise it scans all perfumes exactly.
+    """
+    def __init__(self, perfume_mapping, W, vectorizer=None, H=None, index=None, n_probe=8,
+                 cache_size=10000, batch_window=0.002, max_batch=64):
+        self.W_normalized = normalize_rows(W)
+        self.ids = perfume_mapping['index'].to_numpy()
+        self.brands = perfume_mapping['brand'].astype(str).to_numpy()
+        self.names = perfume_mapping['perfume_name'].astype(str).to_numpy()
+        self.rows = {
+            (brand.lower(), name.lower()): row for row, (brand, name) in enumerate(zip(self.brands, self.names))
+        }
+        self.row_of_id = {perfume_id: row for row, perfume_id in enumerate(self.ids)}
+        self.vectorizer = vectorizer
+        self.H = H
+        self.index = index
+        self.n_probe = n_probe
+        self.cache = QueryCache(cache_size)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.batched_queries = 0
+        threading.Thread(target=self.run_batcher, name="batcher", daemon=True).start()
+
+    def stats(self):
+        with self.stats_lock:
+            batches, batched_queries = self.batches, self.batched_queries
+        return {
+            "perfumes": len(self.ids),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_size": len(self.cache.entries),
+            "batches": batches,
+            "mean_batch_size": batched_queries / batches if batches else 0.0,
+        }
+
+    def query(self, kind, payload, k=10):
+        """
+        Answer one query: kind is 'perfume' with payload (brand, perfume_name), or
+        'text' with a description. Raises KeyError for an unknown perfume.
+        """
+        key = (kind, payload, k)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        pending = PendingQuery(kind, payload, k)
+        self.pending.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        self.cache.put(key, pending.result)
+        return pending.result
+
+    def query_many(self, queries, k=10):
+        """Answer a list of (kind, payload) queries; errors are returned per query."""
+        pending = []
+        for kind, payload in queries:
+            result = self.cache.get((kind, payload, k))
+            item = PendingQuery(kind, payload, k)
+            if result is not None:
+                item.result = result
+                item.done.set()
+            else:
+                self.pending.put(item)
+            pending.append(item)
+        answers = []
+        for item in pending:
+            item.done.wait()
+            if item.error is not None:
+                answers.append({"error": str(item.error.args[0] if item.error.args else item.error)})
+            else:
+                self.cache.put((item.kind, item.payload, item.k), item.result)
+                answers.append(item.result)
+        return answers
+
+    def run_batcher(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.answer(batch)
+            except Exception as e:
+                for item in batch:
+                    if not item.done.is_set():
+                        item.error = e
+                        item.done.set()
+            with self.stats_lock:
+                self.batches += 1
+                self.batched_queries += len(batch)
+
+    def answer(self, batch):
+        """Compute the answers of a batch of queries and wake up their requests."""
+        vectors, exclude_rows, answered = [], [], []
+        for item in batch:
+            if item.kind == 'perfume':
+                brand, name = item.payload
+                row = self.rows.get((brand.lower(), name.lower()))
+                if row is None:
+                    item.error = KeyError(f"No perfume '{name}' by '{brand}'.")
+                    item.done.set()
+                    continue
+                vectors.append(self.W_normalized[row])
+                exclude_rows.append(row)
+                answered.append(item)
+
+        texts = [item for item in batch if item.kind == 'text']
+        if texts:
+            if self.vectorizer is None or self.H is None:
+                for item in texts:
+                    item.error = ValueError("Free-text queries need --tfidf_matrix_file.")
+                    item.done.set()
+            else:
+                try:
+                    text_vectors = self.project_texts([item.payload for item in texts])
+                except Exception as e:
+                    # Fail only the text queries; perfume queries in the batch still get answers
+                    text_vectors = []
+                    for item in texts:
+                        item.error = e
+                        item.done.set()
+                for item, vector in zip(texts, text_vectors):
+                    if not vector.any():
+                        # No known term in the description: every score would be 0.0, so
+                        # any k perfumes would do. Answer with no results instead
+                        item.result = []
+                        item.done.set()
+                        continue
+                    vectors.append(vector)
+                    exclude_rows.append(-1)
+                    answered.append(item)
+        if not answered:
+            return
+
+        k = max(item.k for item in answered)
+        rows, scores = self.search(np.array(vectors), k, np.array(exclude_rows))
+        for item, item_rows, item_scores in zip(answered, rows, scores):
+            if item.kind == 'text':
+                # Perfumes sharing no topic with the description score 0.0 and are not matches
+                item_rows, item_scores = item_rows[item_scores > 0], item_scores[item_scores > 0]
+            item.result = [
+                {"index": int(self.ids[row]), "brand": self.brands[row], "perfume_name": self.names[row],
+                 "score": round(float(score), 6)}
+                for row, score in zip(item_rows[:item.k], item_scores[:item.k]) if row >= 0 and np.isfinite(score)
+            ]
+            item.done.set()
+
+    def project_texts(self, texts):
+        """Preprocess descriptions like the corpus, then map them to normalized topic vectors."""
+        from tt_data_preprocess import preprocess
+        from tt_nmf_dim_reduction import project
+        tfidf = self.vectorizer.transform([preprocess(text) for text in texts])
+        return normalize_rows(project(tfidf, self.H, 200))
+
+    def search(self, vectors, k, exclude_rows):
+        """Rows and scores of the k best perfumes for each normalized query vector."""
+        if self.index is not None:
+            exclude_ids = np.where(exclude_rows >= 0, self.ids[np.maximum(exclude_rows, 0)], -1)
+            ids, scores = self.index.query(vectors, k, self.n_probe, exclude_ids)
+            rows = np.array([[self.row_of_id.get(i, -1) for i in row] for row in ids])
+            return rows, scores
+        scores = vectors @ self.W_normalized.T
+        has_self = exclude_rows >= 0
+        scores[np.flatnonzero(has_self), exclude_rows[has_self]] = -np.inf
+        k = min(k, scores.shape[1] - 1)
+        best = np.argpartition(-scores, k, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+class SimilarityServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 makes bursts of clients wait for TCP retries
+    request_queue_size = 128
+
+def make_handler(service):
+    class SimilarityRequestHandler(BaseHTTPRequestHandler):
+        """
+        GET  /similar?brand=...&perfume_name=...&k=10
+        GET  /similar_text?text=...&k=10
+        GET  /stats
+        POST /batch  {"k": 10, "queries": [{"brand": ..., "perfume_name": ...}, {"text": ...}]}
+        """
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+            required = {"/similar": ["brand", "perfume_name"], "/similar_text": ["text"]}.get(url.path, [])
+            missing = [name for name in required if name not in params]
+            if missing:
+                self.send_json(400, {"error": f"Missing parameters: {', '.join(missing)}"})
+                return
+            try:
+                k = int(params.get("k", 10))
+                if k < 1:
+                    raise ValueError("k must be at least 1")
+                if url.path == "/similar":
+                    payload = (params["brand"], params["perfume_name"])
+                    self.send_json(200, {"query": params, "results": service.query('perfume', payload, k)})
+                elif url.path == "/similar_text":
+                    self.send_json(200, {"query": params, "results": service.query('text', params["text"], k)})
+                elif url.path == "/stats":
+                    self.send_json(200, service.stats())
+                else:
+                    self.send_json(404, {"error": f"Unknown path {url.path}"})
+            except KeyError as e:
+                self.send_json(404, {"error": e.args[0]})
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+            except Exception as e:
+                self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/batch":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                queries = [
+                    ('text', query["text"]) if "text" in query else ('perfume', (query["brand"], query["perfume_name"]))
+                    for query in body["queries"]
+                ]
+                k = int(body.get("k", 10))
+                if k < 1:
+                    raise ValueError("k must be at least 1")
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {"error": f"Malformed batch request: {e}"})
+                return
+            try:
+                self.send_json(200, {"results": service.query_many(queries, k)})
+            except Exception as e:
+                self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            pass  # Keep the console quiet under load
+
+    return SimilarityRequestHandler
+
+def load_service(perfume_mapping_file, nmf_file, tfidf_matrix_file=None, index_dir=None, n_probe=8,
+                 cache_size=10000, batch_window=0.002, max_batch=64):
+    """Load the mapping, the memory-mapped topic vectors and, optionally, the text model and index."""
+    from tt_tfidf import load_vectorizer
+    perfume_mapping = read_table(perfume_mapping_file)
+    nmf_arrays, _ = load_arrays(nmf_file)
+    vectorizer = load_vectorizer(tfidf_matrix_file) if tfidf_matrix_file else None
+    index = IVFIndex.load(index_dir) if index_dir else None
+    return SimilarityService(perfume_mapping, nmf_arrays['W'], vectorizer, nmf_arrays['H'], index, n_probe,
+                             cache_size, batch_window, max_batch)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve perfume similarity queries over HTTP")
+    parser.add_argument("--perfume_mapping_file", type=str, required=True, help="Path to the perfume mapping file.")
+    parser.add_argument("--nmf_file", type=str, required=True, help="Path to the NMF matrices folder.")
+    parser.add_argument("--tfidf_matrix_file", type=str, default=None, help="TF-IDF matrix folder, whose vectorizer state enables free-text queries (optional).")
+    parser.add_argument("--index_dir", type=str, default=None, help="Approximate nearest-neighbor index to search instead of an exact scan (optional).")
+    parser.add_argument("--n_probe", type=int, default=8, help="Index lists scanned per query (default: 8).")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080).")
+    parser.add_argument("--cache_size", type=int, default=10000, help="Number of query results kept in the LRU cache (default: 10000).")
+    parser.add_argument("--batch_window_ms", type=float, default=2.0, help="How long the batcher waits to group queries, in ms (default: 2).")
+    parser.add_argument("--max_batch", type=int, default=64, help="Maximum number of queries answered together (default: 64).")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    service = load_service(args.perfume_mapping_file, args.nmf_file, args.tfidf_matrix_file, args.index_dir,
+                           args.n_probe, args.cache_size, args.batch_window_ms / 1000, args.max_batch)
+    server = SimilarityServer((args.host, args.port), make_handler(service))
+    print(f"Loaded {len(service.ids)} perfumes in {time.perf_counter() - start:.2f}s. "
+          f"Listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
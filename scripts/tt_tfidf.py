@@ -1,31 +1,36 @@
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer, HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import normalize
 import argparse
-import pickle
+import hashlib
+from tt_io import table_format, read_table, iter_table_chunks, write_table, save_sparse_matrix, load_sparse_matrix, load_arrays
 
-def compute_tfidf(input_csv, output_tfidf, output_mapping):
-    # Step 1: Load the data
-    df = pd.read_csv(input_csv)
-    
-    # Ensure that the DataFrame has the expected columns
-    if not {'brand', 'perfume_name', 'descriptors'}.issubset(df.columns):
-        raise ValueError("Input CSV file must contain 'brand', 'perfume_name', and 'descriptors' columns.")
-    
-    # Step 2: Handle missing values
-    # Convert 'descriptors' to string type
-    df['descriptors'] = df['descriptors'].astype(str)
-    
-    # Replace 'nan' strings with actual NaN
-    df['descriptors'] = df['descriptors'].replace('nan', pd.NA)
+def clean_descriptors(df, retype, verbose=True):
+    """
+    Drop rows with missing or empty descriptors. retype converts descriptors read from
+    CSV to strings first, turning the 'nan' strings back into missing values.
+    """
+    if retype:
+        # Convert 'descriptors' to string type
+        df['descriptors'] = df['descriptors'].astype(str)
+        
+        # Replace 'nan' strings with actual NaN
+        df['descriptors'] = df['descriptors'].replace('nan', pd.NA)
+    # Columnar files already store descriptors as strings with real missing values
     
     # Check for missing values in 'descriptors'
     missing_count = df['descriptors'].isnull().sum()
-    print(f"Number of missing descriptors: {missing_count}")
+    if verbose:
+        print(f"Number of missing descriptors: {missing_count}")
     
     if missing_count > 0:
         # Remove rows with missing descriptors
         df = df.dropna(subset=['descriptors'])
-        print(f"Removed {missing_count} rows with missing descriptors.")
+        if verbose:
+            print(f"Removed {missing_count} rows with missing descriptors.")
         # Reset the index
         df = df.reset_index(drop=True)
     
@@ -34,43 +39,266 @@ def compute_tfidf(input_csv, output_tfidf, output_mapping):
     if empty_count > 0:
         df = df[df['descriptors'].str.strip() != '']
         df = df.reset_index(drop=True)
-        print(f"Removed {empty_count} rows with empty descriptors.")
+        if verbose:
+            print(f"Removed {empty_count} rows with empty descriptors.")
+    return df
+
+def load_perfume_descriptors(input_csv):
+    """
+    Load the preprocessed descriptors, drop missing and empty ones and combine them
+    into one row per (brand, perfume_name).
+    """
+    # Step 1: Load the data (CSV, or Parquet/Feather written by the preprocessing step)
+    df = read_table(input_csv)
+    
+    # Ensure that the DataFrame has the expected columns
+    if not {'brand', 'perfume_name', 'descriptors'}.issubset(df.columns):
+        raise ValueError("Input file must contain 'brand', 'perfume_name', and 'descriptors' columns.")
+    
+    # Step 2: Handle missing values
+    df = clean_descriptors(df, table_format(input_csv) == 'csv')
     
     # Step 3: Combine descriptors for each unique perfume
-    df = df.groupby(['brand', 'perfume_name'], as_index=False).agg({'descriptors': ' '.join})
+    # observed=True keeps categorical columns from producing every brand/name combination
+    df = df.groupby(['brand', 'perfume_name'], as_index=False, observed=True).agg({'descriptors': ' '.join})
     # Reset index after grouping
     df = df.reset_index(drop=True)
     print(f"Combined descriptors for {len(df)} unique perfumes.")
+    return df
+
+def descriptor_hashes(descriptors):
+    """Return a 64-bit content hash per combined descriptor string, to spot changed perfumes."""
+    return np.array(
+        [int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little') for text in descriptors],
+        dtype=np.uint64,
+    )
+
+def smooth_idf(doc_freq, n_docs):
+    """IDF as TfidfVectorizer computes it with smooth_idf=True."""
+    return np.log((1 + n_docs) / (1 + doc_freq)) + 1
+
+def save_tfidf(output_tfidf, tfidf_matrix, terms, idf, doc_freq, hashes, meta=None):
+    """
+    Save the TF-IDF matrix together with the vectorizer state needed to transform new
+    perfumes later: the vocabulary, the IDF weights the matrix was built with, the
+    document frequency of every term and the content hash of every row. The hashing
+    mode has no vocabulary and no row hashes; pass None for those.
+    """
+    state = {'idf': idf, 'doc_freq': doc_freq}
+    if terms is not None:
+        state['terms'] = np.asarray(terms, dtype=str)
+    if hashes is not None:
+        state['row_hashes'] = hashes
+    meta = dict(meta or {'vectorizer': 'exact'})
+    meta['n_docs'] = int(tfidf_matrix.shape[0])
+    save_sparse_matrix(output_tfidf, tfidf_matrix, meta, state)
+
+def load_vectorizer(tfidf_folder):
+    """
+    Rebuild a fitted vectorizer from the state saved next to the TF-IDF matrix: a
+    TfidfVectorizer, or for the hashing mode an equivalent HashingVectorizer pipeline.
+    """
+    arrays, meta = load_arrays(tfidf_folder)
+    if meta.get('vectorizer') == 'hashing':
+        transformer = TfidfTransformer()
+        transformer.idf_ = np.asarray(arrays['idf'])
+        return make_pipeline(hashing_vectorizer(meta['n_features']), transformer)
+    vectorizer = TfidfVectorizer(vocabulary=np.asarray(arrays['terms']))
+    vectorizer.idf_ = np.asarray(arrays['idf'])
+    return vectorizer
+
+def hashing_vectorizer(n_features):
+    """Raw term counts in a fixed feature space, tokenized like TfidfVectorizer."""
+    return HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+
+def compute_tfidf(input_csv, output_tfidf, output_mapping):
+    # Steps 1-3: Load, clean and combine the descriptors
+    df = load_perfume_descriptors(input_csv)
     
     # Step 4: Extract descriptors
     descriptors = df['descriptors'].tolist()
     
     # Step 5: Compute TF-IDF vectors
     vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(descriptors)
-    
-    # Step 6: Save the TF-IDF matrix and mapping
-    # Save the TF-IDF matrix using pickle
-    with open(output_tfidf, 'wb') as f:
-        pickle.dump(tfidf_matrix, f)
+    tfidf_matrix = vectorizer.fit_transform(descriptors).tocsr()
+    tfidf_matrix.sum_duplicates()
+    doc_freq = np.bincount(tfidf_matrix.indices, minlength=tfidf_matrix.shape[1])
     
-    # Save the vectorizer for future use
-    with open('data/tfidf_vectorizer.pkl', 'wb') as f:
-        pickle.dump(vectorizer, f)
+    # Step 6: Save the TF-IDF matrix with the vectorizer state, and the mapping
+    save_tfidf(output_tfidf, tfidf_matrix, vectorizer.get_feature_names_out(), vectorizer.idf_,
+               doc_freq, descriptor_hashes(descriptors))
     
     # Save the mapping of perfumes to their indices
     perfume_mapping = df[['brand', 'perfume_name']].reset_index()
-    perfume_mapping.to_csv(output_mapping, index=False)
+    write_table(perfume_mapping, output_mapping)
+    
+    print(f"TF-IDF matrix and vectorizer state saved to {output_tfidf}")
+    print(f"Perfume mapping saved to {output_mapping}")
+
+def compute_hashed_tfidf(input_csv, output_tfidf, output_mapping, n_features=2**20, chunk_size=100000):
+    """
+    Compute the TF-IDF matrix in one pass over the input with a fixed feature space.
+
+    Each chunk of rows is hashed into term counts, which are summed per (brand,
+    perfume_name) into a running count matrix; the combined descriptor strings and a
+    vocabulary are never held in memory. Document frequencies and IDF come from the
+    accumulated counts once the pass is done. Rows and mapping are ordered like in
+    compute_tfidf, so the two modes can be compared perfume by perfume.
+    """
+    hasher = hashing_vectorizer(n_features)
+    retype = table_format(input_csv) == 'csv'
+    perfume_rows = {}
+    counts = None
+    total_rows = 0
+    
+    # Step 1: Hash each chunk and add its counts to the rows of its perfumes
+    for chunk in iter_table_chunks(input_csv, chunk_size):
+        if not {'brand', 'perfume_name', 'descriptors'}.issubset(chunk.columns):
+            raise ValueError("Input file must contain 'brand', 'perfume_name', and 'descriptors' columns.")
+        chunk = clean_descriptors(chunk.dropna(subset=['brand', 'perfume_name']), retype, verbose=False)
+        total_rows += len(chunk)
+        keys = zip(chunk['brand'].astype(str), chunk['perfume_name'].astype(str))
+        rows = np.array([perfume_rows.setdefault(key, len(perfume_rows)) for key in keys], dtype=np.int64)
+        # Perfume-by-row indicator matrix: multiplying sums the counts of each perfume's rows
+        indicator = sp.csr_matrix(
+            (np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(perfume_rows), len(rows))
+        )
+        chunk_counts = indicator @ hasher.transform(chunk['descriptors'])
+        if counts is None:
+            counts = chunk_counts
+        else:
+            counts.resize((len(perfume_rows), n_features))
+            counts = counts + chunk_counts
+        print(f"Hashed {total_rows} rows into {len(perfume_rows)} perfumes...")
+    if counts is None:
+        raise ValueError(f"{input_csv} contains no descriptors.")
+    
+    # Step 2: Order perfumes like the groupby in compute_tfidf
+    keys = sorted(perfume_rows)
+    counts = counts[[perfume_rows[key] for key in keys]].tocsr()
+    counts.sum_duplicates()
+    
+    # Step 3: IDF from the accumulated document frequencies, then l2-normalized tf * idf
+    doc_freq = np.bincount(counts.indices, minlength=n_features)
+    idf = smooth_idf(doc_freq, counts.shape[0])
+    tfidf_matrix = normalize(counts.multiply(idf).tocsr())
+    print(f"Combined descriptors for {len(keys)} unique perfumes "
+          f"({np.count_nonzero(doc_freq)} of {n_features} hash buckets used).")
+    
+    # Step 4: Save the matrix with the hashing state, and the mapping
+    save_tfidf(output_tfidf, tfidf_matrix, None, idf, doc_freq, None,
+               {'vectorizer': 'hashing', 'n_features': n_features})
+    write_table(pd.DataFrame(keys, columns=['brand', 'perfume_name']).reset_index(), output_mapping)
+    print(f"TF-IDF matrix and hashing state saved to {output_tfidf}")
+    print(f"Perfume mapping saved to {output_mapping}")
+
+def update_tfidf(input_csv, output_tfidf, output_mapping, drift_threshold=0.05):
+    """
+    Fold new and changed perfumes into an existing TF-IDF matrix instead of refitting.
+
+    Only perfumes whose combined descriptors are new or differ from the stored content
+    hash are tokenized, with the saved vocabulary and IDF weights. Changed perfumes keep
+    their row (and index), new ones are appended. Document frequencies are kept up to
+    date; once the IDF they imply has drifted from the IDF the matrix was built with by
+    more than drift_threshold (mean relative change), every row is rescaled to the new
+    IDF. Terms outside the saved vocabulary are ignored; their share is reported, and a
+    full run without --update rebuilds the vocabulary.
+    """
+    # Step 1: Load the stored matrix, vectorizer state and mapping
+    arrays, meta = load_arrays(output_tfidf)
+    if meta.get('vectorizer') == 'hashing':
+        raise ValueError(f"{output_tfidf} was built with --vectorizer hashing, which has no --update mode; rerun it instead.")
+    if 'doc_freq' not in arrays:
+        raise ValueError(f"{output_tfidf} has no vectorizer state; run once without --update first.")
+    tfidf_matrix = load_sparse_matrix(output_tfidf)
+    terms = np.asarray(arrays['terms'])
+    idf = np.asarray(arrays['idf'])
+    doc_freq = np.array(arrays['doc_freq'])
+    row_hashes = np.asarray(arrays['row_hashes'])
+    n_docs = meta['n_docs']
+    perfume_mapping = read_table(output_mapping)
+    stored_rows = {
+        key: i for i, key in enumerate(zip(perfume_mapping['brand'].astype(str), perfume_mapping['perfume_name'].astype(str)))
+    }
+    
+    # Step 2: Find new and changed perfumes
+    df = load_perfume_descriptors(input_csv)
+    hashes = descriptor_hashes(df['descriptors'])
+    changed, added = [], []
+    for position, key in enumerate(zip(df['brand'].astype(str), df['perfume_name'].astype(str))):
+        row = stored_rows.get(key)
+        if row is None:
+            added.append(position)
+        elif row_hashes[row] != hashes[position]:
+            changed.append((position, row))
+    print(f"{len(added)} new and {len(changed)} changed perfumes out of {len(df)}.")
+    if not added and not changed:
+        print("TF-IDF matrix is up to date.")
+        return
+    
+    # Step 3: Count terms of the delta with the saved vocabulary
+    delta = [position for position, _ in changed] + added
+    analyzer = TfidfVectorizer().build_analyzer()
+    tokens = [analyzer(text) for text in df['descriptors'].iloc[delta]]
+    counts = CountVectorizer(vocabulary=terms, analyzer=lambda doc: doc).transform(tokens).tocsr()
+    total_tokens = sum(len(doc) for doc in tokens)
+    if total_tokens:
+        print(f"{1 - counts.sum() / total_tokens:.1%} of the new tokens are outside the saved vocabulary.")
+    
+    # Step 4: Update document frequencies: drop the old rows of changed perfumes, add the delta
+    changed_rows = np.array([row for _, row in changed], dtype=np.int64)
+    if len(changed_rows):
+        doc_freq -= np.bincount(tfidf_matrix[changed_rows].indices, minlength=len(terms))
+    doc_freq += np.bincount(counts.indices, minlength=len(terms))
+    n_docs += len(added)
+    
+    # Step 5: Build the delta rows with the current IDF, then splice them in
+    delta_rows = normalize(counts.multiply(idf).tocsr())
+    n_stored = tfidf_matrix.shape[0]
+    order = np.arange(n_stored + len(added))
+    order[changed_rows] = n_stored + np.arange(len(changed))
+    order[n_stored:] = n_stored + len(changed) + np.arange(len(added))
+    tfidf_matrix = sp.vstack([tfidf_matrix, delta_rows], format='csr')[order]
+    row_hashes = np.concatenate([row_hashes, hashes[added]])
+    row_hashes[changed_rows] = hashes[[position for position, _ in changed]]
+    
+    # Step 6: Refit the IDF weights once they have drifted too far
+    new_idf = smooth_idf(doc_freq, n_docs)
+    drift = float(np.mean(np.abs(new_idf - idf) / idf))
+    print(f"IDF drift: {drift:.4f} (threshold {drift_threshold}).")
+    if drift > drift_threshold:
+        # Rows are l2-normalized tf * idf, so rescaling by new_idf / idf and renormalizing
+        # gives exactly the rows a refit with the new IDF would produce
+        tfidf_matrix = normalize(tfidf_matrix.multiply(new_idf / idf).tocsr())
+        idf = new_idf
+        print("IDF refitted and all rows rescaled.")
     
-    print(f"TF-IDF matrix saved to {output_tfidf}")
-    print(f"Vectorizer saved to data/tfidf_vectorizer.pkl")
+    # Step 7: Save the matrix, state and the mapping with the new perfumes appended
+    save_tfidf(output_tfidf, tfidf_matrix, terms, idf, doc_freq, row_hashes, meta)
+    new_perfumes = df[['brand', 'perfume_name']].iloc[added].astype(str).reset_index(drop=True)
+    new_perfumes.insert(0, 'index', np.arange(n_stored, n_stored + len(added)))
+    perfume_mapping = perfume_mapping[['index', 'brand', 'perfume_name']].astype({'brand': str, 'perfume_name': str})
+    write_table(pd.concat([perfume_mapping, new_perfumes], ignore_index=True), output_mapping)
+    print(f"TF-IDF matrix updated in {output_tfidf} ({tfidf_matrix.shape[0]} perfumes)")
     print(f"Perfume mapping saved to {output_mapping}")
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute TF-IDF vectors for perfume descriptors.')
-    parser.add_argument('--input_csv', type=str, required=True, help='Path to the input CSV file containing preprocessed data.')
-    parser.add_argument('--output_tfidf', type=str, default='tfidf_matrix.pkl', help='Path to save the TF-IDF matrix (default: tfidf_matrix.pkl)')
-    parser.add_argument('--output_mapping', type=str, default='perfume_mapping.csv', help='Path to save the perfume mapping CSV file (default: perfume_mapping.csv)')
+    parser.add_argument('--input_csv', type=str, required=True, help='Path to the input CSV (or .parquet/.feather) file containing preprocessed data.')
+    parser.add_argument('--output_tfidf', type=str, default='tfidf_matrix', help='Folder to save the TF-IDF matrix in as .npy arrays (default: tfidf_matrix)')
+    parser.add_argument('--output_mapping', type=str, default='perfume_mapping.csv', help='Path to save the perfume mapping, as CSV or .parquet/.feather (default: perfume_mapping.csv)')
+    parser.add_argument('--vectorizer', type=str, choices=['exact', 'hashing'], default='exact', help='exact: TfidfVectorizer with a learned vocabulary; hashing: fixed feature space built in one pass with bounded memory (default: exact).')
+    parser.add_argument('--n_features', type=int, default=2**20, help='Number of hash buckets for --vectorizer hashing (default: 1048576).')
+    parser.add_argument('--chunk_size', type=int, default=100000, help='Rows read per chunk for --vectorizer hashing (default: 100000).')
+    parser.add_argument('--update', action='store_true', help='Only transform new or changed perfumes into the existing matrix, keeping its vocabulary.')
+    parser.add_argument('--drift_threshold', type=float, default=0.05, help='With --update, mean relative IDF change above which the IDF is refitted (default: 0.05).')
     args = parser.parse_args()
     
-    compute_tfidf(args.input_csv, args.output_tfidf, args.output_mapping)
+    if args.vectorizer == 'hashing':
+        if args.update:
+            parser.error("--update is only available with --vectorizer exact")
+        compute_hashed_tfidf(args.input_csv, args.output_tfidf, args.output_mapping, args.n_features, args.chunk_size)
+    elif args.update:
+        update_tfidf(args.input_csv, args.output_tfidf, args.output_mapping, args.drift_threshold)
+    else:
+        compute_tfidf(args.input_csv, args.output_tfidf, args.output_mapping)
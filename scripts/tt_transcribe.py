@@ -1,20 +1,53 @@
 import re
 import os
 import subprocess
+import signal
+import time
+import multiprocessing
+import queue
+import numpy as np
 import whisper
 import json
 import argparse
 from dotenv import load_dotenv
+from tt_manifest import StageManifest, atomic_write
+
+# Whisper models loaded so far in this process, keyed by model name
+_loaded_models = {}
+
+def get_whisper_model(model_name="base"):
+    """
+    Return the Whisper model for the given name, loading it on first use only.
+    Returns the model and the number of seconds spent loading it (0.0 when it was
+    already loaded by an earlier call).
+    """
+    if model_name in _loaded_models:
+        return _loaded_models[model_name], 0.0
+
+    start = time.perf_counter()
+    model = whisper.load_model(model_name)
+    load_time = time.perf_counter() - start
+    _loaded_models[model_name] = model
+    print(f"Loaded Whisper model '{model_name}' in {load_time:.2f}s.")
+    return model, load_time
+
+def json_output_path(mp4, json_output_folder):
+    """Path of the transcription JSON written for an mp4 file."""
+    basefilename = re.match(r'(.*)\.mp4$', os.path.basename(mp4)).group(1)
+    return os.path.join(json_output_folder, f"{basefilename}.json")
 
 class SpeechConverter:
-    def __init__(self, mp4, json_output_folder, mp3_output_folder, method='openai'):
+    def __init__(self, mp4, json_output_folder, mp3_output_folder=None, method='openai', model_name='base', stream_audio=False):
         self.mp4 = mp4
         self.json_output_folder = json_output_folder
         self.mp3_output_folder = mp3_output_folder
         self.method = method
+        self.stream_audio = stream_audio
         self.basefilename = re.match(r'(.*)\.mp4$', os.path.basename(self.mp4)).group(1)
-        # Load OpenAI Whisper model
-        self.model = whisper.load_model("base")
+        # Reuse the OpenAI Whisper model shared by every converter in this process
+        self.model, load_time = get_whisper_model(model_name)
+        # Seconds spent per step, filled in by extract_and_transform_speech
+        self.timings = {"load": load_time, "conversion": 0.0, "transcription": 0.0}
         
     def convert_mp4_to_mp3(self):
         """Convert mp4 video to mp3 audio."""
@@ -28,8 +61,28 @@ class SpeechConverter:
             print(f"Error during MP3 conversion: {e}")
             return None
         
+    def load_audio_from_mp4(self):
+        """
+        Decode the mp4 audio track in memory as 16 kHz mono float32 PCM, the format
+        Whisper expects, without writing an intermediate mp3 to disk.
+        """
+        ffmpeg_command = [
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-i", self.mp4,
+            "-vn", "-f", "s16le", "-ac", "1", "-ar", str(whisper.audio.SAMPLE_RATE), "-"
+        ]
+        try:
+            result = subprocess.run(ffmpeg_command, capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Error during audio decoding: {e.stderr.decode(errors='replace').strip()}")
+            return None
+        if not result.stdout:
+            print(f"No audio track found in {self.mp4}.")
+            return None
+        print(f"Audio decoded in memory for {self.mp4}.\n")
+        return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
+
     def convert_speech_to_text(self, audio_file):
-        """Transcribe speech to text using the specified method."""
+        """Transcribe speech to text using the specified method. Accepts a file path or a PCM array."""
         try:
             if self.method == 'openai': 
                 result = self.model.transcribe(audio_file)
@@ -43,36 +96,183 @@ class SpeechConverter:
 
     def save_as_json(self, text):
         """Save transcribed text as a JSON file."""
-        output_file = os.path.join(self.json_output_folder, f"{self.basefilename}.json")
-        with open(output_file, 'w') as json_file:
+        output_file = json_output_path(self.mp4, self.json_output_folder)
+        # Written atomically so an interrupted run never leaves a truncated JSON
+        with atomic_write(output_file) as json_file:
             json.dump({"text": text}, json_file, indent=4)
         print(f"Data saved as JSON: {output_file}.\n")
     
     def extract_and_transform_speech(self):
         """Process the mp4 video, transcribe it, and save results as JSON."""
-        # Step 1: Convert mp4 to mp3
-        mp3_file = self.convert_mp4_to_mp3()
-        if mp3_file:
+        # Step 1: Convert mp4 to mp3, or decode the audio straight into memory
+        start = time.perf_counter()
+        if self.stream_audio:
+            audio = self.load_audio_from_mp4()
+        else:
+            audio = self.convert_mp4_to_mp3()
+        self.timings["conversion"] = time.perf_counter() - start
+        if audio is not None:
             # Step 2: Convert speech to text
-            extracted_text = self.convert_speech_to_text(mp3_file)
+            start = time.perf_counter()
+            extracted_text = self.convert_speech_to_text(audio)
+            self.timings["transcription"] = time.perf_counter() - start
             if extracted_text:
                 # Step 3: Save transcribed text as JSON
                 self.save_as_json(extracted_text)
             return extracted_text
         return None
 
+def process_videos_sequentially(mp4_filepaths, json_output_folder, mp3_output_folder, model_name='base', stream_audio=False,
+                                manifest=None):
+    """
+    Transcribe the videos one after another in the current process. Finished videos
+    are recorded in the manifest, when one is given.
+    """
+    total_load = total_transcription = 0.0
+    for mp4_filepath in mp4_filepaths:
+        mp4_file = os.path.basename(mp4_filepath)
+        print(f"Processing video: {mp4_filepath}")
+        speech_converter = SpeechConverter(mp4_filepath, json_output_folder, mp3_output_folder, model_name=model_name, stream_audio=stream_audio)
+        transcription = speech_converter.extract_and_transform_speech()
+
+        if transcription:
+            print(f"Transcription completed for {mp4_file} successfully.")
+            if manifest is not None:
+                manifest.record(mp4_file, [mp4_filepath], [json_output_path(mp4_filepath, json_output_folder)])
+        else:
+            print(f"Transcription failed for {mp4_file}.")
+
+        timings = speech_converter.timings
+        total_load += timings["load"]
+        total_transcription += timings["transcription"]
+        print(f"Timing for {mp4_file}: model load {timings['load']:.2f}s, "
+              f"audio conversion {timings['conversion']:.2f}s, transcription {timings['transcription']:.2f}s")
+
+    print(f"Processed {len(mp4_filepaths)} videos: model load {total_load:.2f}s total, "
+          f"transcription {total_transcription:.2f}s total.")
+
+def transcription_worker(worker_id, task_queue, result_queue, stop_event, json_output_folder, mp3_output_folder, model_name, stream_audio):
+    """
+    Worker process: load the Whisper model once, then transcribe videos taken from
+    the shared task queue until a None sentinel arrives or a stop is requested.
+    """
+    # Ctrl-C is handled by the parent, which asks workers to stop between videos
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    start = time.perf_counter()
+    get_whisper_model(model_name)
+
+    processed = failed = 0
+    busy_time = 0.0
+    while not stop_event.is_set():
+        mp4_filepath = task_queue.get()
+        if mp4_filepath is None:
+            break
+        speech_converter = SpeechConverter(mp4_filepath, json_output_folder, mp3_output_folder, model_name=model_name, stream_audio=stream_audio)
+        transcription = speech_converter.extract_and_transform_speech()
+        timings = speech_converter.timings
+        busy_time += timings["conversion"] + timings["transcription"]
+        if transcription:
+            processed += 1
+        else:
+            failed += 1
+        result_queue.put(("video", worker_id, mp4_filepath, bool(transcription), timings))
+
+    result_queue.put(("stats", worker_id, processed, failed, busy_time, time.perf_counter() - start))
+
+def process_videos_in_parallel(mp4_filepaths, json_output_folder, mp3_output_folder, model_name='base', workers=2, stream_audio=False,
+                               manifest=None):
+    """
+    Transcribe the videos across a pool of worker processes that share one task queue.
+    Finished videos are recorded in the manifest by the parent process only.
+    The first Ctrl-C lets each worker finish its current video and exit; a second one
+    terminates the workers immediately.
+    """
+    # Spawn fresh interpreters so no torch state is inherited from the parent
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    stop_event = context.Event()
+
+    for mp4_filepath in mp4_filepaths:
+        task_queue.put(mp4_filepath)
+    for _ in range(workers):
+        task_queue.put(None)
+
+    processes = [
+        context.Process(
+            target=transcription_worker,
+            args=(worker_id, task_queue, result_queue, stop_event, json_output_folder, mp3_output_folder, model_name, stream_audio),
+        )
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    worker_stats = {}
+    while len(worker_stats) < workers:
+        try:
+            message = result_queue.get(timeout=1)
+        except KeyboardInterrupt:
+            if stop_event.is_set():
+                print("Second interrupt received, terminating workers.")
+                for process in processes:
+                    process.terminate()
+                break
+            print("Interrupt received, finishing current videos before stopping (Ctrl-C again to force).")
+            stop_event.set()
+            continue
+        except queue.Empty:
+            # Queue timeout: stop waiting for workers that died without reporting
+            if not any(process.is_alive() for process in processes) and result_queue.empty():
+                break
+            continue
+
+        if message[0] == "video":
+            _, worker_id, mp4_filepath, success, timings = message
+            mp4_file = os.path.basename(mp4_filepath)
+            if success and manifest is not None:
+                manifest.record(mp4_file, [mp4_filepath], [json_output_path(mp4_filepath, json_output_folder)])
+            status = "completed" if success else "failed"
+            print(f"[worker {worker_id}] Transcription {status} for {mp4_file} "
+                  f"(conversion {timings['conversion']:.2f}s, transcription {timings['transcription']:.2f}s)")
+        else:
+            _, worker_id, processed, failed, busy_time, wall_time = message
+            worker_stats[worker_id] = (processed, failed, busy_time, wall_time)
+
+    for process in processes:
+        process.join()
+    # Videos left unprocessed after an interrupt must not block interpreter exit
+    task_queue.cancel_join_thread()
+
+    # Remove temporary files left behind by workers that were terminated mid-write
+    for file_name in os.listdir(json_output_folder):
+        if file_name.startswith(".") and file_name.endswith(".tmp"):
+            os.remove(os.path.join(json_output_folder, file_name))
+
+    print("Per-worker throughput:")
+    for worker_id, (processed, failed, busy_time, wall_time) in sorted(worker_stats.items()):
+        rate = (processed + failed) / wall_time * 60 if wall_time > 0 else 0.0
+        print(f"  worker {worker_id}: {processed} ok, {failed} failed, {rate:.1f} videos/min, "
+              f"busy {busy_time:.1f}s of {wall_time:.1f}s")
+
 def main():
     # Set up argparse for CLI arguments
     parser = argparse.ArgumentParser(description="Batch Video Transcription Script")
     parser.add_argument("data_folder", type=str, help="Path to the folder containing mp4 video files.")
     parser.add_argument("json_output_folder", type=str, help="Path to the folder where JSON results will be saved.")
-    parser.add_argument("mp3_output_folder", type=str, help="Path to the folder where MP3 files will be saved.")
+    parser.add_argument("mp3_output_folder", type=str, nargs="?", help="Path to the folder where MP3 files will be saved (not needed with --stream_audio).")
+    parser.add_argument("--model", type=str, default="base", choices=whisper.available_models(), help="Whisper model size to use (default: base).")
+    parser.add_argument("--stream_audio", action="store_true", help="Decode audio in memory and skip writing MP3 files.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each with its own model (default: 1).")
+    parser.add_argument("--force", action="store_true", help="Reprocess every video, even those whose transcription is up to date.")
     args = parser.parse_args()
+    if not args.stream_audio and not args.mp3_output_folder:
+        parser.error("mp3_output_folder is required unless --stream_audio is set.")
 
     # Ensure output folders exist
     if not os.path.exists(args.json_output_folder):
         os.makedirs(args.json_output_folder)
-    if not os.path.exists(args.mp3_output_folder):
+    if args.mp3_output_folder and not os.path.exists(args.mp3_output_folder):
         os.makedirs(args.mp3_output_folder)
 
     # Get list of all .mp4 files in the specified directory
@@ -82,17 +282,24 @@ def main():
         print(f"No mp4 files found in directory {args.data_folder}.")
         return
 
-    # Process each video file
+    # Skip videos whose transcription is up to date with the manifest
+    manifest = StageManifest(args.json_output_folder, "transcribe", {"model": args.model})
+    mp4_filepaths = []
     for mp4_file in mp4_files:
         mp4_filepath = os.path.join(args.data_folder, mp4_file)
-        print(f"Processing video: {mp4_filepath}")
-        speech_converter = SpeechConverter(mp4_filepath, args.json_output_folder, args.mp3_output_folder)
-        transcription = speech_converter.extract_and_transform_speech()
+        if args.force or not manifest.is_up_to_date(mp4_file, [mp4_filepath], [json_output_path(mp4_filepath, args.json_output_folder)]):
+            mp4_filepaths.append(mp4_filepath)
+    print(f"{len(mp4_files) - len(mp4_filepaths)} of {len(mp4_files)} videos already transcribed, {len(mp4_filepaths)} to process.")
+    if not mp4_filepaths:
+        return
 
-        if transcription:
-            print(f"Transcription completed for {mp4_file} successfully.")
-        else:
-            print(f"Transcription failed for {mp4_file}.")
+    if args.workers > 1:
+        process_videos_in_parallel(mp4_filepaths, args.json_output_folder, args.mp3_output_folder, args.model, args.workers,
+                                   args.stream_audio, manifest)
+    else:
+        process_videos_sequentially(mp4_filepaths, args.json_output_folder, args.mp3_output_folder, args.model,
+                                    args.stream_audio, manifest)
+    manifest.compact()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file